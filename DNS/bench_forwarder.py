@@ -0,0 +1,129 @@
+"""
+Queries-per-second benchmark for the caching forwarder ('dns_resolver.py serve').
+
+Starts a local fake upstream (stub_server.StubDNSServer), runs the forwarder
+with the requested number of worker processes in front of it, and floods it
+from several client processes, each keeping a window of queries in flight.
+
+Two phases are measured:
+    cold - every query is a new name, so each one is forwarded upstream
+    warm - queries cycle over a small set of names answered from the cache
+
+Usage: python bench_forwarder.py [--workers N] [--clients N] [--duration SECONDS]
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from dns_resolver import build_dns_query
+from stub_server import StubDNSServer
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _client(port, duration, window, name_prefix, name_count, results):
+    """Keeps 'window' queries in flight against the forwarder and counts answers."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.5)
+    address = ("127.0.0.1", port)
+    answered = 0
+    sent = 0
+
+    def send_next():
+        nonlocal sent
+        hostname = f"{name_prefix}{sent % name_count}.bench.example"
+        sock.sendto(build_dns_query(hostname)[0], address)
+        sent += 1
+
+    for _ in range(window):
+        send_next()
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        try:
+            sock.recv(4096)
+            answered += 1
+        except socket.timeout:
+            # Assume the window's worth of queries was lost and refill it
+            for _ in range(window):
+                send_next()
+            continue
+        send_next()
+    sock.close()
+    results.put(answered)
+
+
+def run_phase(port, clients, duration, window, warm):
+    results = multiprocessing.Queue()
+    processes = []
+    for i in range(clients):
+        # Cold: a unique name per query. Warm: 100 names shared by all clients.
+        prefix = "warm" if warm else f"cold{i}-"
+        name_count = 100 if warm else 10**9
+        processes.append(
+            multiprocessing.Process(
+                target=_client, args=(port, duration, window, prefix, name_count, results)
+            )
+        )
+    for process in processes:
+        process.start()
+    answered = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return answered / duration
+
+
+def wait_until_serving(port, timeout=10):
+    """Polls the forwarder until it answers a query."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            sock.sendto(build_dns_query("ready.bench.example")[0], ("127.0.0.1", port))
+            sock.recv(4096)
+            return
+        except OSError:
+            continue
+    raise RuntimeError("Forwarder did not start.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--window", type=int, default=32)
+    parser.add_argument("--port", type=int, default=15353)
+    args = parser.parse_args()
+
+    upstream = StubDNSServer(ips=["10.0.0.1", "10.0.0.2"]).start()
+    forwarder = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(SCRIPT_DIR, "dns_resolver.py"),
+            "serve",
+            "--port", str(args.port),
+            "--workers", str(args.workers),
+            "--upstream", f"{upstream.address[0]}:{upstream.address[1]}",
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_until_serving(args.port)
+        print(f"Forwarder: {args.workers} worker(s), {args.clients} client(s), window {args.window}")
+        cold_qps = run_phase(args.port, args.clients, args.duration, args.window, warm=False)
+        print(f"  cold (all misses): {cold_qps:,.0f} queries/s")
+        # Prime every worker's cache before measuring hits
+        run_phase(args.port, args.clients, 0.5, args.window, warm=True)
+        warm_qps = run_phase(args.port, args.clients, args.duration, args.window, warm=True)
+        print(f"  warm (cache hits): {warm_qps:,.0f} queries/s")
+        print(f"  upstream saw {upstream.queries} queries")
+    finally:
+        forwarder.terminate()
+        forwarder.wait()
+        upstream.stop()
@@ -0,0 +1,56 @@
+"""
+Micro-benchmark for parse_dns_response() on packets with many compressed answers.
+
+Usage: python bench_parse.py [answers_per_packet] [iterations]
+"""
+
+import struct
+import sys
+import time
+
+from dns_resolver import CLASS_IN, TYPE_A, encode_dns_name, parse_dns_response
+
+
+def build_compressed_response(transaction_id, hostname, answer_count, compression=1.0):
+    """
+    Builds a response whose answer names are all compression pointers back to
+    the question name (offset 12), the way real servers encode them.
+    With compression < 1.0 only that fraction of the answers use a pointer;
+    the rest spell out the full name.
+    """
+    header = struct.pack(
+        "!HHHHHH", transaction_id, 0x8180, 1, answer_count, 0, 0
+    )
+    encoded_name = encode_dns_name(hostname)
+    question = encoded_name + struct.pack("!HH", TYPE_A, CLASS_IN)
+    expanded = round(answer_count * (1.0 - compression))
+    answers = b""
+    for i in range(answer_count):
+        answers += encoded_name if i < expanded else b"\xc0\x0c"
+        answers += struct.pack("!HHIH", TYPE_A, CLASS_IN, 300, 4)
+        answers += struct.pack("!BBBB", 10, (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+    return header + question + answers
+
+
+def run(answer_count=50, iterations=20000):
+    transaction_id = 0x1234
+    packet = build_compressed_response(
+        transaction_id, "www.some-long-subdomain.example.com", answer_count
+    )
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        ips, ttl = parse_dns_response(packet, transaction_id)
+    elapsed = time.perf_counter() - start
+
+    assert len(ips) == answer_count and ttl == 300
+    print(f"Packet size: {len(packet)} bytes, {answer_count} compressed answers")
+    print(f"Parsed {iterations} packets in {elapsed:.3f}s")
+    print(f"  {iterations / elapsed:,.0f} packets/s")
+    print(f"  {iterations * answer_count / elapsed:,.0f} records/s")
+
+
+if __name__ == "__main__":
+    answers = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    iters = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    run(answers, iters)
@@ -0,0 +1,197 @@
+"""
+Offline benchmark suite for dns_resolver.py.
+
+Everything runs against a local fake upstream (stub_server.StubDNSServer), so
+no packet leaves the machine. Measured:
+    encode  - encode_dns_name() and build_dns_query() calls/s
+    parse   - parse_dns_response() packets/s, with and without name compression
+    cache   - resolve() latency for cache hits and for misses
+    resolve - end-to-end resolve() and resolve_many() queries/s
+
+Results are written as JSON so runs from different commits can be compared.
+
+Usage: python bench_resolver.py [--output results.json] [--compare old.json]
+                                [--latency SECONDS] [--loss FRACTION]
+                                [--timeout SECONDS] [--quick]
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import dns_resolver
+from bench_parse import build_compressed_response
+from dns_resolver import DNSCache, build_dns_query, encode_dns_name, parse_dns_response
+from stub_server import StubDNSServer
+
+HOSTNAME = "www.some-long-subdomain.example.com"
+
+
+def _rate(fn, iterations):
+    """Calls fn() 'iterations' times and returns calls per second."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return iterations / (time.perf_counter() - start)
+
+
+def _latencies(samples):
+    """Summarizes per-call latencies (seconds) as microsecond percentiles."""
+    samples = sorted(samples)
+
+    def percentile(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))] * 1e6
+
+    return {
+        "p50_us": round(percentile(0.50), 2),
+        "p90_us": round(percentile(0.90), 2),
+        "p99_us": round(percentile(0.99), 2),
+        "mean_us": round(sum(samples) / len(samples) * 1e6, 2),
+    }
+
+
+def bench_encode(iterations):
+    return {
+        "encode_dns_name_per_s": round(_rate(lambda: encode_dns_name(HOSTNAME), iterations)),
+        "build_dns_query_per_s": round(_rate(lambda: build_dns_query(HOSTNAME), iterations)),
+    }
+
+
+def bench_parse(iterations, answer_count=20):
+    results = {}
+    for label, compression in (("compressed", 1.0), ("uncompressed", 0.0)):
+        packet = build_compressed_response(0x1234, HOSTNAME, answer_count, compression)
+        ips, _ = parse_dns_response(packet, 0x1234)
+        assert len(ips) == answer_count
+        results[f"parse_{label}_packets_per_s"] = round(
+            _rate(lambda: parse_dns_response(packet, 0x1234), iterations)
+        )
+    return results
+
+
+def bench_cache(iterations):
+    cache = DNSCache()
+    dns_resolver.resolve(HOSTNAME, cache=cache)  # Warm the entry
+    hits = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        dns_resolver.resolve(HOSTNAME, cache=cache)
+        hits.append(time.perf_counter() - start)
+    misses = []
+    for i in range(min(iterations, 2000)):
+        start = time.perf_counter()
+        dns_resolver.resolve(f"miss{i}.bench.example", cache=cache)
+        misses.append(time.perf_counter() - start)
+    return {"cache_hit": _latencies(hits), "cache_miss": _latencies(misses)}
+
+
+def bench_resolve(count, timeout):
+    start = time.perf_counter()
+    for i in range(count):
+        dns_resolver.resolve(f"seq{i}.bench.example", use_cache=False)
+    sequential_qps = count / (time.perf_counter() - start)
+
+    hostnames = [f"batch{i}.bench.example" for i in range(count * 5)]
+    start = time.perf_counter()
+    results = dns_resolver.resolve_many(hostnames, timeout=timeout, use_cache=False)
+    batch_qps = len(hostnames) / (time.perf_counter() - start)
+    answered = sum(1 for ips in results.values() if ips)
+    return {
+        "resolve_qps": round(sequential_qps),
+        "resolve_many_qps": round(batch_qps),
+        "resolve_many_answered": answered / len(hostnames),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(latency=0.0, loss=0.0, timeout=0.25, quick=False):
+    iterations = 2000 if quick else 20000
+    # Lost queries would otherwise stall each measurement for the full 2s timeout
+    dns_resolver.QUERY_TIMEOUT = timeout
+    upstream = StubDNSServer(
+        delay=latency, loss=loss, ips=[f"10.0.0.{i}" for i in range(1, 5)]
+    ).start()
+    dns_resolver.set_upstreams([upstream.address])
+    try:
+        results = {
+            "meta": {
+                "commit": _git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "upstream_latency_s": latency,
+                "upstream_loss": loss,
+                "query_timeout_s": timeout,
+            },
+            "encode": bench_encode(iterations * 5),
+            "parse": bench_parse(iterations),
+            "cache": bench_cache(iterations),
+            "resolve": bench_resolve(200 if quick else 1000, timeout),
+        }
+        results["meta"]["upstream_queries"] = upstream.queries
+        return results
+    finally:
+        upstream.stop()
+
+
+def _flatten(results, prefix=""):
+    """{'a': {'b': 1}} -> {'a.b': 1}, skipping the metadata."""
+    flat = {}
+    for key, value in results.items():
+        if key == "meta":
+            continue
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(old, new):
+    """Prints every metric side by side with the change in percent."""
+    old_flat, new_flat = _flatten(old), _flatten(new)
+    print(f"{'metric':<45} {'old':>12} {'new':>12} {'change':>8}")
+    for key, new_value in new_flat.items():
+        old_value = old_flat.get(key)
+        if not old_value:
+            print(f"{key:<45} {'-':>12} {new_value:>12}")
+            continue
+        change = (new_value - old_value) / old_value * 100
+        print(f"{key:<45} {old_value:>12} {new_value:>12} {change:>+7.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--latency", type=float, default=0.0, help="upstream delay in seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="fraction of queries dropped")
+    parser.add_argument("--timeout", type=float, default=0.25, help="per-query timeout")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations")
+    args = parser.parse_args()
+
+    results = run(args.latency, args.loss, args.timeout, args.quick)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -1,103 +1,1153 @@
+import argparse
+import asyncio
+import atexit
+import bisect
+import concurrent.futures
+import contextlib
+import gc
+import heapq
+import itertools
+import json
+import logging
+import mmap
+import multiprocessing
+import os
 import socket
 import struct
 import random
+import signal
+import threading
 import time
 import sys
+from collections import OrderedDict
+
+# Quiet by default: nothing is printed unless the application configures logging
+logger = logging.getLogger("dns_resolver")
+logger.addHandler(logging.NullHandler())
 
 # --- Cache ---
-# Structure: { 'hostname': {'ips': ['ip1', 'ip2'], 'expiry_time': timestamp} }
-DNS_CACHE = {}
+CACHE_MAX_ENTRIES = 10000
+CACHE_MAX_BYTES = None  # Optional approximate memory budget; None = entry count only
+CACHE_ENTRY_OVERHEAD = 200  # Rough per-entry bookkeeping cost in bytes
+
+# --- Serve-Stale / Refresh-Ahead ---
+# Seconds past expiry an entry may still be served if the upstream is slow or
+# unreachable (RFC 8767 suggests 1-3 days). 0 disables serve-stale.
+STALE_MAX_AGE = 0
+STALE_CLIENT_TIMEOUT = 1.8  # How long to wait for a fresh answer before serving stale
+PREFETCH = False  # Refresh popular entries in the background before they expire
+PREFETCH_THRESHOLD = 0.1  # ...once less than this fraction of their TTL is left
+PREFETCH_MIN_HITS = 3  # ...and they have been hit at least this many times
+
+# --- Cache Snapshots ---
+SNAPSHOT_INTERVAL = 300  # Seconds between periodic snapshots of the cache
+SNAPSHOT_MAGIC = b"DNSC"
+SNAPSHOT_VERSION = 3
+# Magic, version, entry count, total IP count, byte sizes of the name and IP blobs
+SNAPSHOT_HEADER_STRUCT = struct.Struct("<4sHIIII")
+# struct codes of the per-entry columns: absolute expiry time, TTL, entry size,
+# query type, negative flag, rcode, IP count, byte length of the name
+SNAPSHOT_COLUMNS = "dIIH?BHH"
+
+
+class DNSCache:
+    """
+    Bounded, thread-safe DNS cache with LRU eviction and TTL expiry.
+
+    Entries are dicts: {'ips': ['ip1', 'ip2'], 'expiry_time': timestamp,
+    'ttl': seconds, 'hits': count, 'negative': bool, 'rcode': int}.
+    Once max_entries (or the approximate max_bytes budget) is exceeded, the
+    least recently used entries are evicted. Expired entries are purged
+    proactively from a min-heap of expiry times rather than waiting for the
+    same key to be looked up again. With stale_max_age > 0, expired entries
+    are kept that much longer so they can be served stale.
+
+    Anything with the same get(key, now, allow_stale) /
+    set(key, ips, ttl, now, negative, rcode) methods can be passed to resolve()
+    as its cache. save()/load() write and read snapshots of the
+    (name, query type) entries so a restarted process starts warm. Loaded
+    entries stay packed in the snapshot's columns until first used, so in
+    _entries a value is either an entry dict or a row number in self._rows.
+    """
+
+    def __init__(
+        self,
+        max_entries=CACHE_MAX_ENTRIES,
+        max_bytes=CACHE_MAX_BYTES,
+        stale_max_age=STALE_MAX_AGE,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_max_age = stale_max_age
+        self._entries = OrderedDict()  # { key: entry }, least recently used first
+        self._rows = None  # _SnapshotRows behind the row numbers in _entries
+        self._expiry_heap = []  # [(expiry_time, key)], may hold outdated items
+        self._lock = threading.RLock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_hits = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __repr__(self):
+        return f"<DNSCache {len(self)} entries: {dict(self._entries)!r}>"
+
+    @staticmethod
+    def _entry_size(key, ips):
+        """Approximate memory footprint of one entry."""
+        return CACHE_ENTRY_OVERHEAD + len(str(key)) + sum(len(ip) for ip in ips)
+
+    def peek(self, key):
+        """Returns the entry for key without touching LRU order or counters."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else self._entry(key, entry)
+
+    def get(self, key, now=None, allow_stale=False):
+        """
+        Returns the live entry for key, or None on a miss or an expired entry.
+        With allow_stale, an expired entry still inside the stale window is
+        returned too; callers tell the two apart by its expiry_time.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry = self._entry(key, entry)
+            if entry["expiry_time"] <= now:
+                if entry["expiry_time"] + self.stale_max_age <= now:
+                    self._remove(key)
+                    self.expirations += 1
+                elif allow_stale:
+                    self._entries.move_to_end(key)
+                    self.stale_hits += 1
+                    return entry
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            entry["hits"] += 1
+            self.hits += 1
+            return entry
+
+    def set(self, key, ips, ttl, now=None, negative=False, rcode=0):
+        """
+        Caches ips under key for ttl seconds and returns the new entry.
+        'negative' marks a cached NXDOMAIN/NODATA answer (with no IPs);
+        'rcode' tells the two apart.
+        """
+        if now is None:
+            now = time.time()
+        entry = {
+            "ips": ips,
+            "expiry_time": now + ttl,
+            "ttl": ttl,
+            "hits": 0,
+            "negative": negative,
+            "rcode": rcode,
+            "size": self._entry_size(key, ips),
+        }
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry["size"]
+            heapq.heappush(self._expiry_heap, (entry["expiry_time"], key))
+            self.purge_expired(now)
+            self._evict()
+        return entry
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry_heap.clear()
+            self._bytes = 0
+            self._rows = None
+
+    def purge_expired(self, now=None):
+        """
+        Drops every entry whose TTL (plus stale window) has run out.
+        Returns how many were dropped.
+        """
+        if now is None:
+            now = time.time()
+        purged = 0
+        with self._lock:
+            heap = self._expiry_heap
+            while heap and heap[0][0] + self.stale_max_age <= now:
+                expiry_time, key = heapq.heappop(heap)
+                entry = self._entries.get(key)
+                # Skip heap items left behind by entries that were replaced or evicted
+                if entry is not None and self._expiry_time(entry) == expiry_time:
+                    self._remove(key)
+                    purged += 1
+            self.expirations += purged
+            # Outdated heap items pile up when keys are refreshed; rebuild occasionally
+            if len(heap) > 2 * len(self._entries) + 64:
+                self._expiry_heap = [
+                    (self._expiry_time(entry), key) for key, entry in self._entries.items()
+                ]
+                heapq.heapify(self._expiry_heap)
+        return purged
+
+    def stats(self):
+        """Returns hit/miss/eviction counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "stale_hits": self.stale_hits,
+            }
+
+    def save(self, path):
+        """
+        Writes every (name, query type) entry to a snapshot file at path,
+        least recently used first, and returns how many were written.
+        Expiry times are stored as absolute timestamps. The file is replaced
+        atomically, so readers never see a half-written snapshot.
+
+        Layout: a header, one little-endian array per SNAPSHOT_COLUMNS field
+        (every entry's expiry time, then every TTL, ...), the byte length of
+        every IP as a uint32 array, then the names and the IPs as two
+        concatenated UTF-8 blobs. Every string is length-prefixed rather than
+        separated, since TXT data and upstream names can hold any character.
+        """
+        with _gc_paused():
+            with self._lock:
+                items = list(self._entries.items())
+                rows = self._rows
+            # Only resolver-style (name, query type) keys are saved
+            items = [item for item in items if isinstance(item[0], tuple) and len(item[0]) == 2]
+            names = [name.encode() for (name, _), _ in items]
+            records = [
+                rows.record(entry)  # Still packed from load(); written as is
+                if type(entry) is int
+                else (
+                    entry["expiry_time"],
+                    int(entry["ttl"]),
+                    entry["size"],
+                    entry["negative"],
+                    entry["rcode"],
+                    [ip.encode() for ip in entry["ips"]],
+                )
+                for _, entry in items
+            ]
+            expiry_times, ttls, sizes, negatives, rcodes, entry_ips = (
+                zip(*records) if records else ((),) * 6
+            )
+            ips = list(itertools.chain.from_iterable(entry_ips))
+            columns = (
+                expiry_times,
+                ttls,
+                sizes,
+                [query_type for (_, query_type), _ in items],
+                negatives,
+                rcodes,
+                list(map(len, entry_ips)),
+                list(map(len, names)),
+            )
+        count = len(names)
+        names_blob = b"".join(names)
+        ips_blob = b"".join(ips)
+        header = SNAPSHOT_HEADER_STRUCT.pack(
+            SNAPSHOT_MAGIC,
+            SNAPSHOT_VERSION,
+            count,
+            len(ips),
+            len(names_blob),
+            len(ips_blob),
+        )
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            for code, column in zip(SNAPSHOT_COLUMNS, columns):
+                f.write(struct.pack(f"<{count}{code}", *column))
+            f.write(struct.pack(f"<{len(ips)}I", *map(len, ips)))
+            f.write(names_blob)
+            f.write(ips_blob)
+        os.replace(tmp_path, path)
+        return count
+
+    def load(self, path, now=None):
+        """
+        Adds the entries of a snapshot written by save() and returns how many
+        were loaded. Entries past their expiry (and stale window) are dropped,
+        and entries already in the cache win over the snapshot's. The file is
+        memory-mapped and each column read with a single unpack. Only the keys
+        and the expiry heap are built here; an entry's dict is built from its
+        row the first time the key is used.
+        Raises ValueError for a file that isn't a snapshot.
+        """
+        if now is None:
+            now = time.time()
+        with _gc_paused():
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if len(mm) < SNAPSHOT_HEADER_STRUCT.size:
+                    raise ValueError("Snapshot too short for header.")
+                magic, version, count, ip_total, names_size, ips_size = (
+                    SNAPSHOT_HEADER_STRUCT.unpack_from(mm)
+                )
+                if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                    raise ValueError(f"Not a version {SNAPSHOT_VERSION} cache snapshot.")
+                formats = [f"<{count}{code}" for code in SNAPSHOT_COLUMNS] + [f"<{ip_total}I"]
+                names_offset = SNAPSHOT_HEADER_STRUCT.size + sum(map(struct.calcsize, formats))
+                ips_offset = names_offset + names_size
+                if ips_offset + ips_size > len(mm):
+                    raise ValueError("Snapshot is truncated.")
+                columns = []
+                offset = SNAPSHOT_HEADER_STRUCT.size
+                for fmt in formats:
+                    columns.append(struct.unpack_from(fmt, mm, offset))
+                    offset += struct.calcsize(fmt)
+                names_blob = mm[names_offset:ips_offset]
+                ips_blob = mm[ips_offset : ips_offset + ips_size]
+            (
+                expiry_times,
+                ttls,
+                sizes,
+                query_types,
+                negatives,
+                rcodes,
+                ip_counts,
+                name_lengths,
+                ip_lengths,
+            ) = columns
+            if (
+                sum(ip_counts) != ip_total
+                or sum(name_lengths) != names_size
+                or sum(ip_lengths) != ips_size
+            ):
+                raise ValueError("Snapshot lengths don't match its blobs.")
+
+            keys = list(zip(_split_blob(names_blob, name_lengths), query_types))
+            rows = _SnapshotRows(
+                expiry_times, ttls, sizes, negatives, rcodes, ip_counts, ip_lengths, ips_blob
+            )
+            row_numbers = range(count)
+            cutoff = now - self.stale_max_age
+            live = [expiry_time > cutoff for expiry_time in expiry_times]
+            if not all(live):
+                keys, row_numbers, expiry_times, sizes = (
+                    list(itertools.compress(column, live))
+                    for column in (keys, row_numbers, expiry_times, sizes)
+                )
+            loaded = OrderedDict(zip(keys, row_numbers))
+            heap = list(zip(expiry_times, keys))
+            loaded_bytes = sum(sizes)
+
+        with self._lock:
+            # Snapshot entries count as older than anything cached since startup
+            for key in self._entries.keys() & loaded.keys():
+                loaded_bytes -= rows.sizes[loaded.pop(key)]
+            count = len(loaded)
+            if count:
+                rows.pending = count
+                if self._rows is None:
+                    self._rows = rows
+                else:
+                    # Rows from an earlier load are still in use; ours go after them
+                    first = len(self._rows)
+                    loaded = OrderedDict((key, row + first) for key, row in loaded.items())
+                    self._rows.extend(rows)
+            loaded.update(self._entries)
+            self._entries = loaded
+            self._bytes += loaded_bytes
+            heap.extend(self._expiry_heap)  # Outdated items get skipped when purged
+            heapq.heapify(heap)
+            self._expiry_heap = heap
+            evictions = self.evictions
+            self._evict()
+            # Snapshot entries sit at the LRU end, so they are evicted first
+            return max(0, count - (self.evictions - evictions))
+
+    def _entry(self, key, entry):
+        """
+        Returns the entry dict for a value of _entries, building it from its
+        snapshot row first if it is still a row number.
+        """
+        if type(entry) is not int:
+            return entry
+        entry = self._rows.entry(entry)
+        self._entries[key] = entry  # Same key, so its place in the LRU order is kept
+        self._release_row()
+        return entry
+
+    def _expiry_time(self, entry):
+        if type(entry) is int:
+            return self._rows.expiry_times[entry]
+        return entry["expiry_time"]
+
+    def _release_row(self):
+        self._rows.pending -= 1
+        if not self._rows.pending:
+            self._rows = None  # Every loaded row has been built or dropped
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        if type(entry) is int:
+            self._bytes -= self._rows.sizes[entry]
+            self._release_row()
+        else:
+            self._bytes -= entry["size"]
+
+    def _evict(self):
+        """Evicts least recently used entries until both limits are met."""
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+
+class _SnapshotRows:
+    """
+    The entries of loaded snapshots, column by column. DNSCache keeps a row
+    number in place of each entry and builds the entry dict on first use,
+    since building a million dicts up front was most of a load's time.
+    """
+
+    def __init__(
+        self, expiry_times, ttls, sizes, negatives, rcodes, ip_counts, ip_lengths, ips_blob
+    ):
+        self.expiry_times = list(expiry_times)
+        self.ttls = list(ttls)
+        self.sizes = list(sizes)
+        self.negatives = list(negatives)
+        self.rcodes = list(rcodes)
+        # Row i's IPs are IPs ip_starts[i]:ip_starts[i + 1], and IP j is
+        # ips_blob[ip_offsets[j]:ip_offsets[j + 1]]
+        self.ip_starts = list(itertools.accumulate(ip_counts, initial=0))
+        self.ip_offsets = list(itertools.accumulate(ip_lengths, initial=0))
+        self.ips_blob = ips_blob
+        self.pending = 0  # Row numbers still standing in for entries in the cache
+
+    def __len__(self):
+        return len(self.expiry_times)
+
+    def extend(self, other):
+        """Appends other's rows, whose numbers go up by the old len(self)."""
+        ip_base, byte_base = self.ip_starts[-1], len(self.ips_blob)
+        self.expiry_times += other.expiry_times
+        self.ttls += other.ttls
+        self.sizes += other.sizes
+        self.negatives += other.negatives
+        self.rcodes += other.rcodes
+        self.ip_starts += [start + ip_base for start in other.ip_starts[1:]]
+        self.ip_offsets += [offset + byte_base for offset in other.ip_offsets[1:]]
+        self.ips_blob += other.ips_blob
+        self.pending += other.pending
+
+    def record(self, row):
+        """
+        (expiry time, TTL, size, negative, rcode, [IP bytes]) for a row, the
+        way save() writes an entry.
+        """
+        offsets, blob = self.ip_offsets, self.ips_blob
+        return (
+            self.expiry_times[row],
+            self.ttls[row],
+            self.sizes[row],
+            self.negatives[row],
+            self.rcodes[row],
+            [
+                blob[offsets[i] : offsets[i + 1]]
+                for i in range(self.ip_starts[row], self.ip_starts[row + 1])
+            ],
+        )
+
+    def entry(self, row):
+        """Builds the entry dict for a row."""
+        offsets, blob = self.ip_offsets, self.ips_blob
+        return {
+            "ips": [
+                blob[offsets[i] : offsets[i + 1]].decode()
+                for i in range(self.ip_starts[row], self.ip_starts[row + 1])
+            ],
+            "expiry_time": self.expiry_times[row],
+            "ttl": self.ttls[row],
+            "hits": 0,
+            "negative": self.negatives[row],
+            "rcode": self.rcodes[row],
+            "size": self.sizes[row],
+        }
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """
+    Turns the cyclic GC off for a block that builds a million small acyclic
+    objects (snapshot save/load), which would otherwise set off collection
+    after collection over the whole cache for nothing.
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def _split_blob(blob, lengths):
+    """
+    Splits concatenated UTF-8 strings back apart, given their byte lengths.
+    An ASCII blob (names are IDNA-encoded) is decoded once and sliced, since
+    its byte and character offsets agree.
+    """
+    ends = list(itertools.accumulate(lengths))
+    if blob.isascii():
+        text = blob.decode("ascii")
+        return [text[start:end] for start, end in zip([0] + ends, ends)]
+    return [blob[start:end].decode() for start, end in zip([0] + ends, ends)]
+
+
+DNS_CACHE = DNSCache()
+
+
+def enable_snapshots(path, interval=SNAPSHOT_INTERVAL, cache=None, load_from=None):
+    """
+    Warms cache (default DNS_CACHE) from the snapshot at path, if there is
+    one, then saves a fresh snapshot every 'interval' seconds from a
+    background thread and once more when the interpreter exits.
+    'load_from' lists the snapshot files to warm from instead of just path.
+    Returns the function that saves a snapshot.
+    """
+    if cache is None:
+        cache = DNS_CACHE
+    for snapshot_path in load_from or [path]:
+        if not os.path.exists(snapshot_path):
+            continue
+        start = time.perf_counter()
+        try:
+            loaded = cache.load(snapshot_path)
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("Ignoring unreadable cache snapshot %s: %s", snapshot_path, e)
+        else:
+            logger.info(
+                "Loaded %d cache entries from %s in %.3fs",
+                loaded,
+                snapshot_path,
+                time.perf_counter() - start,
+            )
+
+    def save():
+        try:
+            saved = cache.save(path)
+            logger.debug("Saved %d cache entries to %s", saved, path)
+        except OSError as e:
+            logger.warning("Could not save cache snapshot %s: %s", path, e)
+
+    def save_periodically():
+        while True:
+            time.sleep(interval)
+            save()
+
+    threading.Thread(target=save_periodically, daemon=True).start()
+    atexit.register(save)
+    return save
 
 # --- Constants ---
 DNS_SERVER_IP = "8.8.8.8"  # Google's Public DNS
 DNS_PORT = 53
 QUERY_TIMEOUT = 2  # seconds
-BUFFER_SIZE = 1024
+BUFFER_SIZE = 4096
+# UDP payload size advertised via EDNS0 (the DNS Flag Day 2020 recommendation).
+# Answers bigger than this come back truncated and are retried over TCP.
+EDNS_UDP_PAYLOAD = 1232
+
+# Precompiled wire formats
+HEADER_STRUCT = struct.Struct("!HHHHHH")  # ID, flags, QD/AN/NS/AR counts
+RR_HEADER_STRUCT = struct.Struct("!HHIH")  # Type, Class, TTL, RDLength
+SOA_TIMERS_STRUCT = struct.Struct("!IIIII")  # Serial, Refresh, Retry, Expire, Minimum
+MAX_POINTER_JUMPS = 127  # More jumps than a name can have labels means a loop
+MAX_CNAME_CHAIN = 16  # Longest CNAME chain followed before giving up
 
 # DNS Query Types
 TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_PTR = 12
+TYPE_MX = 15
+TYPE_TXT = 16
+TYPE_AAAA = 28
+TYPE_OPT = 41  # EDNS0 pseudo-record
 # DNS Query Classes
 CLASS_IN = 1
+# DNS Response Codes
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+
+# Upper bound on how long NXDOMAIN/NODATA answers are cached (RFC 2308 suggests 1-3 hours)
+NEGATIVE_TTL_MAX = 3 * 3600
+
+
+# --- Metrics and Tracing ---
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+HOOK_STAGES = ("build", "send", "receive", "parse")
+
+
+class Histogram:
+    """Fixed-bucket latency histogram: constant memory however many samples it sees."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last slot is the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates the q-quantile (0..1) as the upper bound of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        cumulative = list(itertools.accumulate(self.counts))
+        buckets = {str(bound): n for bound, n in zip(self.buckets, cumulative)}
+        buckets["+Inf"] = cumulative[-1]
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class Metrics:
+    """
+    Counters, per-upstream latency histograms and optional hooks around the
+    build, send, receive and parse steps of each upstream query.
+    Read it with as_dict(), or prometheus_text() for a scrape endpoint.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # { name: count }
+        self.upstream_latency = {}  # { 'ip:port': Histogram }
+        self.hooks = {stage: [] for stage in HOOK_STAGES}
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe_latency(self, address, seconds):
+        key = f"{address[0]}:{address[1]}"
+        with self._lock:
+            histogram = self.upstream_latency.get(key)
+            if histogram is None:
+                histogram = self.upstream_latency[key] = Histogram()
+            histogram.observe(seconds)
+
+    def add_hook(self, stage, hook):
+        """Registers hook(stage, info_dict) to run at 'build', 'send', 'receive' or 'parse'."""
+        self.hooks[stage].append(hook)
+
+    def remove_hook(self, stage, hook):
+        self.hooks[stage].remove(hook)
+
+    def emit(self, stage, **info):
+        for hook in self.hooks[stage]:
+            hook(stage, info)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.upstream_latency.clear()
+
+    def as_dict(self):
+        """Counters, cache statistics and latency histograms as a plain dict."""
+        with self._lock:
+            counters = dict(self.counters)
+            latency = {key: h.snapshot() for key, h in self.upstream_latency.items()}
+        counters["coalesced_queries"] = SINGLE_FLIGHT.coalesced
+        return {"counters": counters, "cache": DNS_CACHE.stats(), "upstream_latency": latency}
+
+    def prometheus_text(self):
+        """Renders as_dict() in the Prometheus text exposition format."""
+        snapshot = self.as_dict()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE dns_resolver_{name}_total counter")
+            lines.append(f"dns_resolver_{name}_total {value}")
+        for name, value in snapshot["cache"].items():
+            kind = "gauge" if name in ("entries", "bytes", "hit_ratio") else "counter"
+            metric = f"dns_resolver_cache_{name}" + ("_total" if kind == "counter" else "")
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.append(f"{metric} {value}")
+        lines.append("# TYPE dns_resolver_upstream_latency_seconds histogram")
+        for upstream, histogram in sorted(snapshot["upstream_latency"].items()):
+            label = f'upstream="{upstream}"'
+            for bound, count in histogram["buckets"].items():
+                lines.append(
+                    f'dns_resolver_upstream_latency_seconds_bucket{{{label},le="{bound}"}} {count}'
+                )
+            lines.append(f"dns_resolver_upstream_latency_seconds_sum{{{label}}} {histogram['sum']}")
+            lines.append(
+                f"dns_resolver_upstream_latency_seconds_count{{{label}}} {histogram['count']}"
+            )
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+# --- Static Hosts Override ---
+STATIC_TTL = 3600  # TTL the forwarder gives to answers from the static index
+
+
+class _TrieNode:
+    __slots__ = ("children", "records", "wildcard")
+
+    def __init__(self):
+        self.children = {}  # { label: _TrieNode }
+        self.records = None  # { query type: [data] } once a name ends here
+        self.wildcard = None  # { query type: [data] } for '*.<this name>'
+
+
+class HostsIndex:
+    """
+    In-memory index of pinned names, stored as a trie keyed by labels in
+    reverse order ('www.example.com' -> com, example, www), so names sharing
+    a suffix share nodes and a lookup costs one dict probe per label.
+
+    Exact names win over wildcards; '*.example.com' matches any name below
+    example.com that has no exact entry, and the deepest wildcard wins.
+    Indexes are built once and then only read: to change the pinned names,
+    build a new one and swap it in (see load_static_hosts()).
+    """
+
+    def __init__(self):
+        self.root = _TrieNode()
+        self.names = 0
+        self.sources = ((), ())  # (hosts files, zone files) it was loaded from
+
+    def __len__(self):
+        return self.names
+
+    def __repr__(self):
+        return f"<HostsIndex {self.names} names>"
+
+    def add(self, name, query_type, data):
+        """Pins 'data' (an IP for A/AAAA) as a record of query_type for name."""
+        labels = _normalize_name(name).split(".")
+        wildcard = labels[0] == "*"
+        if wildcard:
+            labels = labels[1:]
+        node = self.root
+        for label in reversed(labels):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = _TrieNode()
+            node = child
+        if wildcard:
+            if node.wildcard is None:
+                node.wildcard = {}
+                self.names += 1
+            records = node.wildcard
+        else:
+            if node.records is None:
+                node.records = {}
+                self.names += 1
+            records = node.records
+        values = records.setdefault(query_type, [])
+        if data not in values:
+            values.append(data)
+
+    def lookup(self, hostname, query_type=TYPE_A):
+        """
+        Returns the pinned records of query_type for hostname (normalized), or
+        None if the index doesn't cover the name. A covered name without
+        records of that type gives [], so callers answer it without any
+        network I/O instead of asking the upstream.
+        """
+        node = self.root
+        wildcard = None
+        for label in reversed(hostname.split(".")):
+            if node.wildcard is not None:
+                wildcard = node.wildcard
+            node = node.children.get(label)
+            if node is None:
+                break
+        else:
+            if node.records is not None:
+                return node.records.get(query_type, [])
+        if wildcard is None:
+            return None
+        return wildcard.get(query_type, [])
+
+
+def _address_type(ip):
+    """TYPE_A or TYPE_AAAA for a textual IP, or None if it isn't one."""
+    try:
+        socket.inet_pton(socket.AF_INET6 if ":" in ip else socket.AF_INET, ip)
+    except OSError:
+        return None
+    return TYPE_AAAA if ":" in ip else TYPE_A
+
+
+def parse_hosts_file(lines, index=None):
+    """
+    Adds the entries of an /etc/hosts style file ('IP name [aliases...]')
+    to index (a new HostsIndex by default) and returns it.
+    """
+    if index is None:
+        index = HostsIndex()
+    for line_number, line in enumerate(lines, 1):
+        fields = line.split("#", 1)[0].split()
+        if len(fields) < 2:
+            continue
+        query_type = _address_type(fields[0])
+        if query_type is None:
+            logger.warning("Skipping hosts line %d: bad address %r", line_number, fields[0])
+            continue
+        for name in fields[1:]:
+            try:
+                index.add(name, query_type, fields[0])
+            except ValueError:
+                logger.warning("Skipping hosts line %d: bad name %r", line_number, name)
+    return index
+
+
+def parse_zone_file(lines, index=None, origin=""):
+    """
+    Adds the A/AAAA records of a simple zone file to index (a new HostsIndex
+    by default) and returns it. Understands $ORIGIN, '@', relative names and
+    records of the form 'name [ttl] [IN] type data'; a line starting with
+    whitespace reuses the previous name. Other record types, $TTL and
+    parenthesised multi-line records are skipped.
+    """
+    if index is None:
+        index = HostsIndex()
+    origin = _normalize_name(origin)
+    previous_name = origin
+    record_types = {"A": TYPE_A, "AAAA": TYPE_AAAA}
+    for line_number, line in enumerate(lines, 1):
+        fields = line.split(";", 1)[0].split()
+        if not fields:
+            continue
+        if fields[0].upper() == "$ORIGIN" and len(fields) > 1:
+            origin = _normalize_name(fields[1])
+            continue
+        if fields[0].startswith("$"):
+            continue
+
+        if line[0] in " \t":
+            name = previous_name
+        else:
+            name = fields.pop(0)
+            if name == "@":
+                name = origin
+            elif not name.endswith(".") and origin:
+                name = f"{name}.{origin}"
+            try:
+                name = _normalize_name(name)
+            except ValueError:
+                logger.warning("Skipping zone line %d: bad name %r", line_number, name)
+                continue
+            previous_name = name
+        # Drop the optional TTL and class, leaving 'type data'
+        while fields and (fields[0].isdigit() or fields[0].upper() in ("IN", "CH", "HS")):
+            fields.pop(0)
+        if len(fields) < 2 or fields[0].upper() not in record_types:
+            continue
+        query_type = record_types[fields[0].upper()]
+        if _address_type(fields[1]) != query_type:
+            logger.warning("Skipping zone line %d: bad address %r", line_number, fields[1])
+            continue
+        index.add(name, query_type, fields[1])
+    return index
+
+
+STATIC_HOSTS = HostsIndex()
+
+
+def load_static_hosts(hosts_files=(), zone_files=()):
+    """
+    Builds a fresh index from the given hosts and zone files and swaps it in
+    as STATIC_HOSTS. Lookups keep using the old index until the new one is
+    complete, and replacing the module attribute is atomic, so a reload never
+    blocks or half-applies. Returns the new index.
+    """
+    global STATIC_HOSTS
+    index = HostsIndex()
+    index.sources = (tuple(hosts_files), tuple(zone_files))
+    for path in hosts_files:
+        with open(path) as f:
+            parse_hosts_file(f, index)
+    for path in zone_files:
+        with open(path) as f:
+            parse_zone_file(f, index)
+    STATIC_HOSTS = index
+    logger.info("Loaded %d static names", len(index))
+    return index
+
+
+def reload_static_hosts():
+    """
+    Re-reads the files STATIC_HOSTS was last loaded from. On a read error the
+    current index stays in place. Returns the index in use afterwards.
+    """
+    hosts_files, zone_files = STATIC_HOSTS.sources
+    try:
+        return load_static_hosts(hosts_files, zone_files)
+    except OSError as e:
+        logger.warning("Keeping the current static hosts, reload failed: %s", e)
+        return STATIC_HOSTS
+
+
+# --- Upstream Servers ---
+UPSTREAM_SERVERS = [(DNS_SERVER_IP, DNS_PORT), ("1.1.1.1", DNS_PORT)]
+# Send a second, staggered query to the next-best server if the first hasn't
+# answered after this many seconds. None disables racing.
+HEDGE_DELAY = None
+RTT_SMOOTHING = 0.125  # Weight of each new RTT sample in the smoothed RTT (as in TCP)
+UPSTREAM_MAX_FAILURES = 3  # Consecutive failures before a server is considered down
+UPSTREAM_RETRY_AFTER = 30  # Seconds before a down server is tried again
+
+
+class Upstream:
+    """One upstream DNS server with its smoothed RTT and failure score."""
+
+    def __init__(self, address):
+        self.address = address  # (ip, port)
+        self.srtt = None  # Smoothed RTT in seconds; None until the first answer
+        self.failures = 0  # Consecutive failures
+        self.last_failure = 0.0
+
+    def __repr__(self):
+        srtt = "?" if self.srtt is None else f"{self.srtt * 1000:.1f}ms"
+        return f"<Upstream {self.address[0]}:{self.address[1]} srtt={srtt} failures={self.failures}>"
+
+    def is_healthy(self, now=None):
+        if self.failures < UPSTREAM_MAX_FAILURES:
+            return True
+        if now is None:
+            now = time.monotonic()
+        return now - self.last_failure >= UPSTREAM_RETRY_AFTER
+
+    def score(self):
+        """Expected latency; lower is better. Unmeasured servers go first so they get probed."""
+        if self.srtt is None:
+            return 0.0
+        return self.srtt * (2 ** min(self.failures, 6))
+
+    def record_success(self, rtt):
+        self.record_rtt(rtt)
+        self.failures = 0
+
+    def record_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt += RTT_SMOOTHING * (rtt - self.srtt)
+
+    def record_failure(self):
+        self.failures += 1
+        self.last_failure = time.monotonic()
+
+
+class UpstreamPool:
+    """Picks the fastest healthy upstream server out of a configurable list."""
+
+    def __init__(self, servers):
+        self.upstreams = [Upstream(tuple(address)) for address in servers]
+        self._by_address = {upstream.address: upstream for upstream in self.upstreams}
+        self._lock = threading.Lock()
+
+    def __contains__(self, address):
+        return address in self._by_address
+
+    def ranked(self):
+        """Returns the upstreams best first: healthy ones by score, then the rest."""
+        now = time.monotonic()
+        with self._lock:
+            return sorted(
+                self.upstreams,
+                key=lambda upstream: (not upstream.is_healthy(now), upstream.score()),
+            )
+
+    def get(self, address):
+        return self._by_address.get(address)
+
+    def record_success(self, upstream, rtt):
+        if upstream is None:
+            return  # Server was removed from the pool while the query was in flight
+        with self._lock:
+            upstream.record_success(rtt)
+        METRICS.observe_latency(upstream.address, rtt)
+
+    def record_failure(self, upstream):
+        if upstream is None:
+            return
+        with self._lock:
+            upstream.record_failure()
+
+    def record_lost_races(self, sent_at, winner, answered_at):
+        """
+        After a hedged query, gives every upstream that was asked before the
+        winner and hadn't answered yet an RTT sample of the time it had so
+        far. Without it a slow primary is never measured once the backup
+        keeps winning, and stays ranked first.
+        """
+        winner_sent = sent_at[winner]
+        with self._lock:
+            for address, sent in sent_at.items():
+                upstream = self._by_address.get(address)
+                if address != winner and sent <= winner_sent and upstream is not None:
+                    upstream.record_rtt(answered_at - sent)
+
+
+UPSTREAMS = UpstreamPool(UPSTREAM_SERVERS)
+
+
+def set_upstreams(servers):
+    """Replaces the upstream servers, e.g. set_upstreams([('127.0.0.1', 5353)])."""
+    global UPSTREAMS
+    UPSTREAMS = UpstreamPool(servers)
+    return UPSTREAMS
 
 
 def encode_dns_name(domain_name):
-    """Encodes a domain name in the DNS format (e.g., www.google.com -> 3www6google3com0)"""
+    """
+    Encodes a domain name in the DNS format (e.g., www.google.com -> 3www6google3com0).
+    Internationalized names are IDNA-encoded first (bücher.de -> xn--bcher-kva.de).
+    Raises ValueError for a name that can't be encoded, e.g. a label over 63 bytes.
+    """
+    if domain_name.isascii():
+        name_bytes = domain_name.encode("ascii")
+    else:
+        name_bytes = domain_name.encode("idna")  # UnicodeError is a ValueError
     encoded = b""
-    for label in domain_name.encode("ascii").split(b"."):
+    for label in name_bytes.split(b"."):
+        if len(label) > 63:
+            raise ValueError(f"DNS label longer than 63 bytes in {domain_name!r}")
         encoded += struct.pack("!B", len(label)) + label
     return encoded + b"\x00"  # Null byte to terminate the name
 
 
-def parse_dns_name(reader):
+def parse_dns_name(data, offset, name_cache=None):
     """
-    Parses a potentially compressed DNS name from a response.
-    'reader' is an object with read(n) and tell() methods, and a 'data' attribute.
-    Returns the decoded name (str) and the number of bytes originally consumed
-    from the reader's position *before* pointer jumps.
+    Decodes a potentially compressed DNS name starting at 'offset' in 'data'
+    (bytes or memoryview) without copying the packet.
+    Compression pointers are followed iteratively, with a cap on the number of
+    jumps to protect against pointer loops. 'name_cache' is an optional
+    { offset: name } dict shared across one packet, so suffixes that were
+    already decoded are reused instead of walked again.
+    Returns the decoded name (str) and the offset just past the name at its
+    original position (i.e. after the first pointer, if any).
     """
+    data_len = len(data)
+    # Fast path: a lone pointer to an already decoded name (typical for answers)
+    if name_cache is not None and offset + 1 < data_len and data[offset] >= 0xC0:
+        target = ((data[offset] & 0x3F) << 8) | data[offset + 1]
+        if target in name_cache:
+            return name_cache[target], offset + 2
+
     parts = []
-    bytes_consumed_original = 0
-    jumped = False
-    expected_end_offset = -1  # Track end offset after first jump
+    label_offsets = []  # Offsets of the labels we decoded, for memoizing suffixes
+    end_offset = -1
+    jumps = 0
+    pos = offset
 
     while True:
-        length_byte = reader.read(1)
-        if not length_byte:
-            raise EOFError("Reached end of data while parsing name.")
+        if name_cache is not None and pos in name_cache:
+            # The rest of this name was already decoded earlier in the packet
+            suffix = name_cache[pos]
+            if suffix:
+                parts.append(suffix)
+            if end_offset < 0:
+                # No pointer seen yet, so the name's own bytes still need skipping
+                end_offset = _skip_dns_name(data, offset)
+            break
 
-        length = length_byte[0]
-        if not jumped:
-            bytes_consumed_original += 1
+        if pos >= data_len:
+            raise EOFError("Reached end of data while parsing name.")
+        length = data[pos]
 
         # Check for pointer (compression)
         if (length & 0xC0) == 0xC0:
-            if not jumped:
-                # This is the first jump, remember where we should be after the pointer
-                expected_end_offset = (
-                    reader.tell() + 1
-                )  # +1 because we need to read the second byte of the pointer
-                jumped = True
-
-            pointer_byte2 = reader.read(1)
-            if not pointer_byte2:
+            if pos + 1 >= data_len:
                 raise EOFError("Reached end of data while parsing name pointer.")
-            if not jumped:  # This check is redundant now but kept for clarity
-                bytes_consumed_original += 1
-
-            offset = ((length & 0x3F) << 8) | pointer_byte2[0]
-            # Create a new reader for the jump
-            import io
-
-            jump_reader = io.BytesIO(reader.data)
-            jump_reader.seek(offset)
-            # Recursively parse the name at the pointer location
-            parts.append(
-                parse_dns_name(jump_reader)[0]
-            )  # Only need the name part from recursive call
-            # If this was the first jump, the parsing for this name is complete.
-            # Return the combined name and the original bytes consumed (usually 2 for the pointer).
-            return ".".join(parts), bytes_consumed_original
+            if end_offset < 0:
+                end_offset = pos + 2  # The name ends right after the first pointer
+            jumps += 1
+            if jumps > MAX_POINTER_JUMPS:
+                raise ValueError("Too many compression pointers (pointer loop?).")
+            pos = ((length & 0x3F) << 8) | data[pos + 1]
 
         # End of name marker
         elif length == 0:
+            if end_offset < 0:
+                end_offset = pos + 1
             break
 
         # Normal label
         else:
-            if not jumped:
-                bytes_consumed_original += length
-            label = reader.read(length)
-            if len(label) < length:
+            label_end = pos + 1 + length
+            if label_end > data_len:
                 raise EOFError("Reached end of data while reading label.")
-            parts.append(label.decode("ascii"))
+            label_offsets.append(pos)
+            parts.append(str(data[pos + 1 : label_end], "ascii"))
+            pos = label_end
+
+    if name_cache is not None:
+        # Every label we walked starts a suffix that later names may point to
+        for i, label_offset in enumerate(label_offsets):
+            name_cache[label_offset] = ".".join(parts[i:])
+    return ".".join(parts), end_offset
 
-    # If we never jumped, the total bytes consumed is correct
-    # If we did jump, the original_bytes_consumed is set before the first jump (usually 2)
-    return ".".join(parts), bytes_consumed_original
+
+def _skip_dns_name(data, offset):
+    """Returns the offset just past the (possibly compressed) name at 'offset'."""
+    data_len = len(data)
+    while offset < data_len:
+        length = data[offset]
+        if (length & 0xC0) == 0xC0:
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += 1 + length
+    raise EOFError("Reached end of data while skipping name.")
 
 
-def build_dns_query(hostname, query_type=TYPE_A):
-    """Builds a DNS query packet for the given hostname and type."""
+def build_dns_query(hostname, query_type=TYPE_A, edns_payload=EDNS_UDP_PAYLOAD):
+    """
+    Builds a DNS query packet for the given hostname and type.
+    Unless edns_payload is None, an EDNS0 OPT record advertises that we can
+    take UDP answers of up to edns_payload bytes.
+    """
     transaction_id = random.randint(0, 65535)
 
     # Header section (12 bytes)
@@ -107,7 +1157,7 @@ def build_dns_query(hostname, query_type=TYPE_A):
     qdcount = 1  # Question count
     ancount = 0  # Answer count
     nscount = 0  # Authority count
-    arcount = 0  # Additional count
+    arcount = 1 if edns_payload else 0  # Additional count (the OPT record)
 
     header = struct.pack(
         "!HHHHHH", transaction_id, flags, qdcount, ancount, nscount, arcount
@@ -119,207 +1169,1574 @@ def build_dns_query(hostname, query_type=TYPE_A):
     qclass = struct.pack("!H", CLASS_IN)
 
     query = header + qname + qtype + qclass
+
+    # Additional section: EDNS0 OPT pseudo-RR (RFC 6891)
+    # Root name, TYPE=OPT, CLASS=UDP payload size, TTL=extended RCODE/version/flags, no RDATA
+    if edns_payload:
+        query += b"\x00" + struct.pack("!HHIH", TYPE_OPT, edns_payload, 0, 0)
     return query, transaction_id
 
 
-def parse_dns_response(response_bytes, expected_id):
-    """Parses the DNS response packet and extracts A records and TTL."""
+def parse_dns_query(query_bytes):
+    """
+    Parses the header and first question of an incoming query.
+    Returns (transaction_id, hostname, query_type, question_end_offset).
+    Raises ValueError for anything that isn't a well-formed single-question query.
+    """
+    data = memoryview(query_bytes)
+    if len(data) < HEADER_STRUCT.size:
+        raise ValueError("Query too short for header.")
+    query_id, flags, qdcount, _, _, _ = HEADER_STRUCT.unpack_from(data, 0)
+    if flags & 0x8000 or qdcount != 1:
+        raise ValueError("Not a single-question query.")
     try:
+        hostname, offset = parse_dns_name(data, HEADER_STRUCT.size)
+        query_type = struct.unpack_from("!H", data, offset)[0]
+    except (EOFError, struct.error) as e:
+        raise ValueError(f"Malformed question: {e}")
+    return query_id, hostname, query_type, offset + 4
+
+
+def build_dns_response(query_bytes, ips, ttl, rcode=RCODE_NOERROR, truncated=False):
+    """
+    Builds a response to query_bytes answering its question with A (or, for
+    AAAA questions, AAAA) records for ips, each with the given TTL. Answer
+    names are compression pointers back to the question name. A truncated
+    response has the TC flag and no answers.
+    """
+    query_id, _, query_type, question_end = parse_dns_query(query_bytes)
+    question = query_bytes[HEADER_STRUCT.size : question_end]
+    # QR=1, RD copied from the query, RA=1
+    flags = 0x8080 | (query_bytes[2] << 8 & 0x0100) | rcode
+    if truncated:
+        return HEADER_STRUCT.pack(query_id, flags | 0x0200, 1, 0, 0, 0) + question
+    header = HEADER_STRUCT.pack(query_id, flags, 1, len(ips), 0, 0)
+    if query_type == TYPE_AAAA:
+        answer_header = b"\xc0\x0c" + RR_HEADER_STRUCT.pack(TYPE_AAAA, CLASS_IN, ttl, 16)
+        answers = b"".join(
+            answer_header + socket.inet_pton(socket.AF_INET6, ip) for ip in ips
+        )
+    else:
+        answer_header = b"\xc0\x0c" + RR_HEADER_STRUCT.pack(TYPE_A, CLASS_IN, ttl, 4)
+        answers = b"".join(answer_header + socket.inet_aton(ip) for ip in ips)
+    return header + question + answers
+
+
+def _decode_rdata(data, offset, rdlength, rr_type, name_cache):
+    """
+    Decodes one record's RDATA into a string: an address for A/AAAA, a name
+    for CNAME/NS/PTR, 'preference exchange' for MX, the joined strings for
+    TXT and hex for anything else. Returns None for malformed RDATA.
+    """
+    rdata_end = offset + rdlength
+    if rr_type == TYPE_A:
+        if rdlength != 4:  # Standard IPv4 length
+            logger.warning("Found A record with unexpected data length %s", rdlength)
+            return None
+        return socket.inet_ntoa(data[offset:rdata_end])
+    if rr_type == TYPE_AAAA:
+        if rdlength != 16:
+            logger.warning("Found AAAA record with unexpected data length %s", rdlength)
+            return None
+        return socket.inet_ntop(socket.AF_INET6, data[offset:rdata_end])
+    if rr_type in (TYPE_CNAME, TYPE_NS, TYPE_PTR):
+        return parse_dns_name(data, offset, name_cache)[0].lower()
+    if rr_type == TYPE_MX:
+        preference = struct.unpack_from("!H", data, offset)[0]
+        return f"{preference} {parse_dns_name(data, offset + 2, name_cache)[0].lower()}"
+    if rr_type == TYPE_TXT:
+        strings = []
+        while offset < rdata_end:
+            length = data[offset]
+            strings.append(str(data[offset + 1 : offset + 1 + length], "utf-8", "replace"))
+            offset += 1 + length
+        return "".join(strings)
+    return data[offset:rdata_end].hex()
+
+
+def parse_dns_answer(response_bytes, expected_id, expected_name=None, expected_type=None):
+    """
+    Parses the DNS response packet into a dict:
+        {'ips': [...], 'ttl': seconds or None, 'negative': bool, 'rcode': int,
+         'name': canonical name, 'rrset_ttl': seconds or None,
+         'cname_chain': [(alias, target, ttl), ...]}
+    'ips' holds the records of the question's type (addresses for A/AAAA)
+    found at the end of any CNAME chain starting at the question name.
+    'ttl' is the smallest TTL along that chain, 'rrset_ttl' the TTL of the
+    final RRset alone. NXDOMAIN and NODATA answers are 'negative', with the
+    TTL taken from the SOA record in the authority section as RFC 2308
+    describes (None if there is no SOA).
+    With expected_name (and expected_type) given, the reply must echo exactly
+    that one question, ignoring case; otherwise it is treated as mismatched,
+    so an answer is never cached under a name or type nobody asked for.
+    Returns None if the packet is malformed, mismatched or an error other
+    than NXDOMAIN.
+    """
+    try:
+        # Work on a memoryview with integer offsets, so nothing is copied
+        data = memoryview(response_bytes)
+
         # --- 1. Parse Header ---
-        header_struct = struct.Struct("!HHHHHH")
-        if len(response_bytes) < header_struct.size:
-            print("Error: Response too short for header.")
-            return None, None
+        if len(data) < HEADER_STRUCT.size:
+            logger.warning("Response too short for header.")
+            return None
 
-        header = header_struct.unpack(response_bytes[: header_struct.size])
-        resp_id, flags, qdcount, ancount, nscount, arcount = header
+        resp_id, flags, qdcount, ancount, nscount, arcount = HEADER_STRUCT.unpack_from(
+            data, 0
+        )
 
         # Verify Transaction ID
         if resp_id != expected_id:
-            print(
-                f"Error: Transaction ID mismatch. Expected {expected_id}, got {resp_id}"
+            logger.warning(
+                "Transaction ID mismatch. Expected %s, got %s", expected_id, resp_id
             )
-            return None, None
+            return None
 
         # Check flags (QR=1 for response, RCODE=0 for no error)
         is_response = (flags & 0x8000) >> 15
-        opcode = (flags & 0x7800) >> 11
-        authoritative = (flags & 0x0400) >> 10
         truncated = (flags & 0x0200) >> 9
-        recursion_desired = (flags & 0x0100) >> 8
-        recursion_available = (flags & 0x0080) >> 7
         rcode = flags & 0x000F
 
         if not is_response:
-            print("Error: Received packet is not a response.")
-            return None, None
-        if rcode != 0:
-            print(f"Error: DNS server returned error code {rcode}")
-            return None, None
+            logger.warning("Received packet is not a response.")
+            return None
+        if rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            logger.warning("DNS server returned error code %s", rcode)
+            return None
         if truncated:
-            print("Warning: Response was truncated. Results may be incomplete.")
-            # We could handle this by retrying with TCP, but that's beyond the scope here.
-
-        # --- 2. Setup Reader and Skip Question Section ---
-        import io
+            # The senders retry truncated answers over TCP before parsing them
+            logger.warning("Response was truncated. Results may be incomplete.")
 
-        reader = io.BytesIO(response_bytes)
-        reader.data = response_bytes  # Store full data for pointer jumps
-        reader.seek(header_struct.size)  # Move past the header
+        # --- 2. Parse Question Section ---
+        offset = HEADER_STRUCT.size
+        name_cache = {}  # { offset: name } for compression pointers in this packet
+        qname, qtype = "", TYPE_A
 
-        for _ in range(qdcount):
-            # Parse and discard the question name
-            qname, name_bytes_len = parse_dns_name(reader)
+        for i in range(qdcount):
+            # Parse the question name (answers usually point back to it)
+            name, offset = parse_dns_name(data, offset, name_cache)
+            if i == 0:
+                qname = name.lower()
+                qtype = struct.unpack_from("!H", data, offset)[0]
             # Skip QTYPE (2 bytes) and QCLASS (2 bytes)
-            reader.seek(reader.tell() + 4)
+            offset += 4
 
-        # --- 3. Parse Answer Section ---
-        ips = []
-        min_ttl = float("inf")
+        if expected_name is not None:
+            expected_name = expected_name.rstrip(".").lower()
+            if qdcount != 1 or qname != expected_name:
+                logger.warning(
+                    "Question mismatch. Expected %s, got %s (%d questions)",
+                    expected_name, qname, qdcount,
+                )
+                return None
+            if expected_type is not None and qtype != expected_type:
+                logger.warning(
+                    "Question type mismatch for %s. Expected %s, got %s",
+                    expected_name, expected_type, qtype,
+                )
+                return None
+            qname = expected_name
 
-        if ancount == 0:
-            print("No answer records found.")
-            # This might be valid (e.g., NXDOMAIN), but for this assignment we seek A records.
-            # We could parse Authority section for SOA record's negative caching TTL if needed.
-            return None, None
+        # --- 3. Parse Answer Section into RRsets ---
+        rrsets = {}  # { (owner name, type): {'ttl': min TTL, 'data': [...]} }
 
+        data_len = len(data)
         for _ in range(ancount):
-            current_pos = reader.tell()
             # Parse name (often compressed)
-            ans_name, name_bytes_len = parse_dns_name(reader)
+            ans_name, offset = parse_dns_name(data, offset, name_cache)
 
             # Read the fixed part of the Resource Record (RR) header (10 bytes)
             # HHIH = Type (2), Class (2), TTL (4), RDLength (2)
-            rr_header_struct = struct.Struct("!HHIH")
-            rr_header_bytes = reader.read(rr_header_struct.size)
-            if len(rr_header_bytes) < rr_header_struct.size:
-                print("Error: Truncated answer RR header.")
+            if offset + RR_HEADER_STRUCT.size > data_len:
+                logger.warning("Truncated answer RR header.")
                 break
-            rr_type, rr_class, rr_ttl, rdlength = rr_header_struct.unpack(
-                rr_header_bytes
+            rr_type, rr_class, rr_ttl, rdlength = RR_HEADER_STRUCT.unpack_from(
+                data, offset
             )
+            offset += RR_HEADER_STRUCT.size
 
-            # Read the RDATA
-            rdata = reader.read(rdlength)
-            if len(rdata) < rdlength:
-                print("Error: Truncated answer RDATA.")
+            # Locate the RDATA
+            rdata_end = offset + rdlength
+            if rdata_end > data_len:
+                logger.warning("Truncated answer RDATA.")
                 break
 
-            # Process A records (IPv4)
-            if rr_type == TYPE_A and rr_class == CLASS_IN:
-                if rdlength == 4:  # Standard IPv4 length
-                    ip_address = socket.inet_ntoa(
-                        rdata
-                    )  # Convert 4 bytes to dotted decimal string
-                    ips.append(ip_address)
-                    min_ttl = min(min_ttl, rr_ttl)
-                    # print(f"  Found A record: {ans_name} -> {ip_address} (TTL: {rr_ttl})") # Debug
-                else:
-                    print(
-                        f"Warning: Found A record with unexpected data length {rdlength}"
-                    )
-            # else: # Debugging for other record types
-            # print(f"  Skipping RR type {rr_type}, class {rr_class} for {ans_name}")
+            if rr_class == CLASS_IN:
+                value = _decode_rdata(data, offset, rdlength, rr_type, name_cache)
+                if value is not None:
+                    key = (ans_name.lower(), rr_type)
+                    rrset = rrsets.get(key)
+                    if rrset is None:
+                        rrset = rrsets[key] = {"ttl": rr_ttl, "data": []}
+                    rrset["data"].append(value)
+                    rrset["ttl"] = min(rrset["ttl"], rr_ttl)
+            offset = rdata_end
 
-        if not ips:
-            print("No valid A records found in the answer section.")
-            return None, None
+        # --- 4. Follow the CNAME Chain from the Question Name ---
+        name = qname
+        cname_chain = []
+        min_ttl = float("inf")
+        if qtype != TYPE_CNAME:
+            while (name, TYPE_CNAME) in rrsets and len(cname_chain) < MAX_CNAME_CHAIN:
+                cname = rrsets[(name, TYPE_CNAME)]
+                cname_chain.append((name, cname["data"][0], cname["ttl"]))
+                min_ttl = min(min_ttl, cname["ttl"])
+                name = cname["data"][0]
 
-        # Ensure we got a valid TTL
-        if min_ttl == float("inf"):
-            print("Warning: Could not determine a valid TTL for A records.")
-            # Decide on a default behavior: maybe return None or a default small TTL?
-            # For simplicity, let's treat this as failure to get a cacheable result.
-            return ips, None
+        final = rrsets.get((name, qtype))
+        if rcode == RCODE_NOERROR and final:
+            return {
+                "ips": final["data"],
+                "ttl": min(min_ttl, final["ttl"]),
+                "negative": False,
+                "rcode": rcode,
+                "name": name,
+                "rrset_ttl": final["ttl"],
+                "cname_chain": cname_chain,
+            }
 
-        return ips, min_ttl
+        # --- 5. Negative Answer: find the SOA in the Authority Section ---
+        if rcode == RCODE_NXDOMAIN:
+            logger.debug("Name does not exist (NXDOMAIN).")
+        else:
+            logger.debug("No records of type %s found for %s (NODATA).", qtype, name)
+        negative_ttl = None
+        for _ in range(nscount):
+            offset = _skip_dns_name(data, offset)
+            if offset + RR_HEADER_STRUCT.size > data_len:
+                break
+            rr_type, rr_class, rr_ttl, rdlength = RR_HEADER_STRUCT.unpack_from(
+                data, offset
+            )
+            offset += RR_HEADER_STRUCT.size
+            if rr_type == TYPE_SOA and offset + rdlength <= data_len:
+                # RDATA: MNAME, RNAME, then SERIAL, REFRESH, RETRY, EXPIRE, MINIMUM
+                soa_offset = _skip_dns_name(data, offset)
+                soa_offset = _skip_dns_name(data, soa_offset)
+                soa_minimum = SOA_TIMERS_STRUCT.unpack_from(data, soa_offset)[4]
+                # RFC 2308: negative TTL is the smaller of the SOA's TTL and MINIMUM
+                negative_ttl = min(rr_ttl, soa_minimum, NEGATIVE_TTL_MAX)
+                break
+            offset += rdlength
+        return {
+            "ips": [],
+            "ttl": None if negative_ttl is None else min(min_ttl, negative_ttl),
+            "negative": True,
+            "rcode": rcode,
+            "name": name,
+            "rrset_ttl": negative_ttl,
+            "cname_chain": cname_chain,
+        }
 
     except EOFError as e:
-        print(f"Error parsing response: Ran out of data. {e}")
-        return None, None
+        logger.warning("Error parsing response: Ran out of data. %s", e)
+        return None
+    except ValueError as e:
+        logger.warning("Error parsing response: Malformed name. %s", e)
+        return None
     except struct.error as e:
-        print(f"Error unpacking data: {e}")
-        return None, None
+        logger.warning("Error unpacking data: %s", e)
+        return None
     except Exception as e:
-        print(f"An unexpected error occurred during parsing: {e}")
-        import traceback
+        logger.exception("An unexpected error occurred during parsing: %s", e)
+        return None
+
 
-        traceback.print_exc()
+def parse_dns_response(response_bytes, expected_id):
+    """
+    Parses the DNS response packet and extracts the answer records and TTL.
+    Returns (ips, ttl), or (None, None) for failures and negative answers.
+    """
+    answer = parse_dns_answer(response_bytes, expected_id)
+    if answer is None or answer["negative"]:
         return None, None
+    return answer["ips"], answer["ttl"]
 
 
-def resolve(hostname, use_cache=True):
+def _normalize_name(hostname):
     """
-    Resolves a hostname to an IP address using manual DNS query and caching.
+    Cache keys use lowercase names without the trailing root dot, with
+    internationalized names in their IDNA form (bücher.de -> xn--bcher-kva.de),
+    the same form the upstream echoes back. Raises ValueError (UnicodeError)
+    for a name IDNA can't encode.
     """
-    global DNS_CACHE
-    current_time = time.time()
+    name = hostname.rstrip(".").lower()
+    if not name.isascii():
+        name = name.encode("idna").decode("ascii")
+    return name
 
-    # --- 1. Check Cache ---
-    if use_cache and hostname in DNS_CACHE:
-        cache_entry = DNS_CACHE[hostname]
-        if cache_entry["expiry_time"] > current_time:
-            print(
-                f"Cache HIT for {hostname}. Returning cached IPs: {cache_entry['ips']}"
+
+def _cache_get_chain(cache, hostname, query_type, current_time, allow_stale=False):
+    """
+    Looks up (hostname, query_type), following cached CNAME RRsets until the
+    final RRset is found. Returns that entry, or None on a miss. When the
+    chain had links, a merged copy is returned whose expiry_time is the
+    earliest along the chain, so the answer is only as fresh as its weakest link.
+    """
+    name = hostname
+    expiry_time = float("inf")
+    for _ in range(MAX_CNAME_CHAIN + 1):
+        cache_entry = cache.get((name, query_type), current_time, allow_stale=allow_stale)
+        if cache_entry is not None:
+            if expiry_time >= cache_entry["expiry_time"]:
+                return cache_entry
+            return dict(cache_entry, expiry_time=expiry_time)
+        if query_type == TYPE_CNAME:
+            return None
+        cname_entry = cache.get((name, TYPE_CNAME), current_time, allow_stale=allow_stale)
+        if cname_entry is None:
+            return None
+        expiry_time = min(expiry_time, cname_entry["expiry_time"])
+        name = cname_entry["ips"][0]
+    return None
+
+
+def _cache_lookup(
+    cache, hostname, current_time, serve_stale=False, prefetch=False, query_type=TYPE_A
+):
+    """
+    Returns the cache entry for hostname, or None on a miss.
+    The entry may be stale (expiry_time in the past) when serve_stale is set.
+    A fresh hit on a popular entry close to expiry kicks off a background refresh.
+    """
+    cache_entry = _cache_get_chain(cache, hostname, query_type, current_time, serve_stale)
+    if cache_entry is None:
+        logger.debug("Cache MISS for %s.", hostname)
+    elif cache_entry["expiry_time"] <= current_time:
+        logger.debug("Cache STALE for %s. Cached IPs: %s", hostname, cache_entry["ips"])
+    elif cache_entry["negative"]:
+        logger.debug("Cache HIT for %s. Cached negative answer.", hostname)
+    else:
+        logger.debug("Cache HIT for %s. Returning cached IPs: %s", hostname, cache_entry["ips"])
+        if prefetch and _should_prefetch(cache_entry, current_time):
+            logger.debug("Prefetching %s before it expires...", hostname)
+            METRICS.inc("prefetches")
+            _refresh_in_background(cache, hostname, query_type)
+    return cache_entry
+
+
+def _should_prefetch(cache_entry, current_time):
+    """True for hot entries that have less than PREFETCH_THRESHOLD of their TTL left."""
+    remaining = cache_entry["expiry_time"] - current_time
+    return (
+        cache_entry["hits"] >= PREFETCH_MIN_HITS
+        and remaining < cache_entry["ttl"] * PREFETCH_THRESHOLD
+    )
+
+
+# --- Background Refreshes ---
+# { (id(cache), hostname, query_type): Thread } for refreshes currently in flight
+_REFRESHES = {}
+_REFRESHES_LOCK = threading.Lock()
+
+
+def _refresh_in_background(cache, hostname, query_type=TYPE_A):
+    """
+    Starts a background upstream query that re-populates hostname in cache,
+    or returns the one already running. Once it finishes, the thread's
+    'answer' attribute holds the parsed answer (None if the upstream failed)
+    and 'result' the resolved IPs (None for failed or negative answers).
+    """
+    key = (id(cache), hostname, query_type)
+    with _REFRESHES_LOCK:
+        thread = _REFRESHES.get(key)
+        if thread is None:
+            thread = threading.Thread(
+                target=_refresh, args=(cache, hostname, query_type, key), daemon=True
+            )
+            thread.answer = None
+            thread.result = None
+            _REFRESHES[key] = thread
+            thread.start()
+    return thread
+
+
+def _refresh(cache, hostname, query_type, key):
+    try:
+        current_time = time.time()
+        answer = _query_upstream(hostname, query_type)
+        thread = threading.current_thread()
+        thread.result = _cache_store(cache, hostname, answer, current_time, query_type)
+        thread.answer = answer
+    finally:
+        with _REFRESHES_LOCK:
+            _REFRESHES.pop(key, None)
+
+
+def _cache_store(cache, hostname, answer, current_time, query_type=TYPE_A):
+    """
+    Stores a parsed answer in the cache, one entry per RRset: every CNAME in
+    the chain under (alias, TYPE_CNAME) and the final records under
+    (canonical name, query_type). Returns the records
+    (or None for failed and negative answers).
+    """
+    if answer is None:
+        logger.debug("Failed to resolve %s.", hostname)
+        METRICS.inc("failures")
+        return None
+    for alias, target, cname_ttl in answer["cname_chain"]:
+        if cname_ttl > 0:
+            cache.set((alias, TYPE_CNAME), [target], cname_ttl, current_time)
+            logger.debug("Cached CNAME %s -> %s, TTL=%ss", alias, target, cname_ttl)
+
+    ips, ttl, name = answer["ips"], answer["rrset_ttl"], answer["name"]
+    if answer["negative"]:
+        if ttl is not None and ttl > 0:
+            cache.set(
+                (name, query_type), [], ttl, current_time, negative=True, rcode=answer["rcode"]
+            )
+            logger.debug(
+                "Cached negative answer for %s (rcode %s), TTL=%ss", name, answer["rcode"], ttl
             )
-            return cache_entry["ips"]
         else:
-            print(f"Cache EXPIRED for {hostname}.")
-            del DNS_CACHE[hostname]  # Remove expired entry
-    elif use_cache:
-        print(f"Cache MISS for {hostname}.")
+            logger.debug("Negative answer for %s has no SOA TTL, not caching.", name)
+        return None
+    if ips and ttl is not None and ttl > 0:
+        cache.set((name, query_type), ips, ttl, current_time)
+        logger.debug("Cached result for %s: IPs=%s, TTL=%ss", name, ips, ttl)
+        return ips
+    elif ips:
+        # Got IPs but no valid TTL for caching
+        logger.debug("Resolved %s to %s but could not cache (invalid TTL).", hostname, ips)
+        return ips
+    else:
+        logger.debug("Failed to resolve %s.", hostname)
+        return None
+
+
+# --- TCP Fallback ---
+class _TCPConnection:
+    """
+    Persistent TCP connection to one upstream. Queries are pipelined: many can
+    be outstanding at once, and a reader thread hands each length-prefixed
+    response to the query with the matching transaction ID.
+    """
+
+    def __init__(self, address, timeout=QUERY_TIMEOUT):
+        self.address = address
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.sock.settimeout(None)  # The reader thread blocks until data or close
+        self.closed = False
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending = {}  # { transaction_id: [threading.Event, response_bytes] }
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def query(self, query_bytes, timeout=QUERY_TIMEOUT):
+        """
+        Sends query_bytes (re-numbered if its ID is already in flight here) and
+        waits for the answer. Returns (response_bytes, transaction_id used).
+        """
+        slot = [threading.Event(), None]
+        with self._lock:
+            if self.closed:
+                raise ConnectionError(f"TCP connection to {self.address} is closed.")
+            query_id = struct.unpack("!H", query_bytes[:2])[0]
+            while query_id in self._pending:
+                query_id = random.randint(0, 65535)
+            self._pending[query_id] = slot
+        query_bytes = struct.pack("!H", query_id) + query_bytes[2:]
+        try:
+            with self._send_lock:
+                self.sock.sendall(struct.pack("!H", len(query_bytes)) + query_bytes)
+            if not slot[0].wait(timeout):
+                raise socket.timeout()
+            if slot[1] is None:
+                raise ConnectionError(f"TCP connection to {self.address} was closed.")
+            return slot[1], query_id
+        finally:
+            with self._lock:
+                self._pending.pop(query_id, None)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            pending = list(self._pending.values())
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        for event, _ in pending:
+            event.set()  # Wake the waiters; their response stays None
+
+    def _read_loop(self):
+        try:
+            while True:
+                length = struct.unpack("!H", self._recv_exact(2))[0]
+                response = self._recv_exact(length)
+                with self._lock:
+                    slot = self._pending.get(struct.unpack("!H", response[:2])[0])
+                if slot is not None:
+                    slot[1] = response
+                    slot[0].set()
+        except (OSError, struct.error):
+            pass  # Server closed the (idle) connection, or it broke
+        finally:
+            self.close()
 
+    def _recv_exact(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed by server.")
+            data += chunk
+        return data
+
+
+class TCPConnectionPool:
+    """Keeps one persistent, pipelined TCP connection per upstream server."""
+
+    def __init__(self):
+        self._connections = {}  # { address: _TCPConnection }
+        self._lock = threading.Lock()
+
+    def query(self, address, query_bytes, timeout=QUERY_TIMEOUT):
+        """Sends a query over TCP to address. Returns (response_bytes, transaction_id)."""
+        for attempt in range(2):
+            connection = self._get(address, timeout)
+            try:
+                return connection.query(query_bytes, timeout)
+            except socket.timeout:
+                raise
+            except OSError:
+                # Most likely the server dropped the idle connection; reconnect once
+                connection.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+    def _get(self, address, timeout):
+        with self._lock:
+            connection = self._connections.get(address)
+            if connection is None or connection.closed:
+                connection = self._connections[address] = _TCPConnection(address, timeout)
+            return connection
+
+
+TCP_POOL = TCPConnectionPool()
+
+
+def _is_truncated(response_bytes):
+    """True if the response has the TC (truncated) flag set."""
+    return len(response_bytes) >= 4 and bool(response_bytes[2] & 0x02)
+
+
+# --- In-flight Request Coalescing ---
+class SingleFlight:
+    """
+    Lets concurrent lookups of the same key share one outstanding upstream query.
+    The first caller (the leader) runs the query; everyone else asking for the
+    same key while it is in flight waits for and gets the leader's result.
+    'coalesced' counts the queries that were saved this way.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # { key: [threading.Event, result] } for blocking callers
+        self._async_calls = {}  # { (loop, key): Future } for coroutines
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Runs fn() for key unless another thread already is, then returns its result."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None]
+            else:
+                self.coalesced += 1
+        if not leader:
+            call[0].wait()
+            if isinstance(call[1], BaseException):
+                raise call[1]  # The leader's query failed; fail the same way
+            return call[1]
+        try:
+            call[1] = fn()
+        except BaseException as exc:
+            call[1] = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
+        return call[1]
+
+    async def do_async(self, key, coro_fn):
+        """Awaits coro_fn() for key unless another task in this loop already is."""
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+        future = self._async_calls.get(flight_key)
+        if future is not None:
+            with self._lock:
+                self.coalesced += 1
+            return await asyncio.shield(future)
+        future = self._async_calls[flight_key] = loop.create_future()
+        try:
+            result = await coro_fn()
+        except asyncio.CancelledError:
+            future.cancel()  # Only the leader was cancelled, not the query's outcome
+            raise
+        except BaseException as exc:
+            # Followers get the leader's exception, not a CancelledError.
+            # Marking it retrieved stops asyncio logging it when nobody waited.
+            future.set_exception(exc)
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._async_calls[flight_key]
+        return result
+
+
+SINGLE_FLIGHT = SingleFlight()
+
+
+def _query_upstream(hostname, query_type=TYPE_A):
+    """
+    Sends a blocking query for hostname and parses the answer, sharing the
+    query with any other thread already waiting on the same name and type.
+    Returns the parse_dns_answer() dict, or None on timeout/socket error.
+    """
+    return SINGLE_FLIGHT.do(
+        (hostname, query_type), lambda: _send_query(hostname, query_type)
+    )
+
+
+def _send_query(hostname, query_type=TYPE_A):
+    """
+    Sends a single blocking query for hostname to the best upstream and parses
+    the answer. With HEDGE_DELAY set, a staggered copy of the query goes to
+    the next-best upstream if the first is slow; whichever answers first wins.
+    """
     # --- 2. Build Query ---
-    print(f"Building query for {hostname}...")
-    query_bytes, query_id = build_dns_query(hostname)
+    logger.debug("Building query for %s (type %s)...", hostname, query_type)
+    query_bytes, query_id = build_dns_query(hostname, query_type)
+    METRICS.emit("build", hostname=hostname, query_id=query_id, query=query_bytes)
+
+    upstreams = UPSTREAMS.ranked()
+    primary = upstreams[0]
+    backup = upstreams[1] if HEDGE_DELAY is not None and len(upstreams) > 1 else None
 
     # --- 3. Send Query via Socket ---
     sock = None
+    sent_at = {}  # { upstream address: monotonic send time }
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(QUERY_TIMEOUT)
+        start = time.monotonic()
+        deadline = start + QUERY_TIMEOUT
 
-        print(f"Sending query to {DNS_SERVER_IP}:{DNS_PORT}...")
-        sock.sendto(query_bytes, (DNS_SERVER_IP, DNS_PORT))
+        logger.debug("Sending query to %s:%s...", *primary.address)
+        sock.sendto(query_bytes, primary.address)
+        sent_at[primary.address] = start
+        METRICS.inc("upstream_queries")
+        METRICS.emit("send", hostname=hostname, query_id=query_id, upstream=primary.address)
 
         # --- 4. Receive Response ---
-        print("Waiting for response...")
-        response_bytes, server_address = sock.recvfrom(BUFFER_SIZE)
-        print(f"Received {len(response_bytes)} bytes from {server_address}")
+        logger.debug("Waiting for response...")
+        while True:
+            now = time.monotonic()
+            if backup is not None and backup.address not in sent_at:
+                hedge_time = start + HEDGE_DELAY
+                if now >= hedge_time:
+                    logger.debug("Upstream slow, racing %s:%s...", *backup.address)
+                    sock.sendto(query_bytes, backup.address)
+                    sent_at[backup.address] = now
+                    METRICS.inc("hedged_queries")
+                    METRICS.emit(
+                        "send", hostname=hostname, query_id=query_id, upstream=backup.address
+                    )
+                    continue
+                wait_until = min(hedge_time, deadline)
+            else:
+                wait_until = deadline
+            if now >= deadline:
+                raise socket.timeout()
+            sock.settimeout(wait_until - now)
+            try:
+                response_bytes, server_address = sock.recvfrom(BUFFER_SIZE)
+            except socket.timeout:
+                continue  # Time to hedge, or the loop above raises at the deadline
+            # Ignore strays: only accept our own query ID from a server we asked
+            if (
+                server_address in sent_at
+                and len(response_bytes) >= 2
+                and struct.unpack("!H", response_bytes[:2])[0] == query_id
+            ):
+                break
+        answered_at = time.monotonic()
+        rtt = answered_at - sent_at[server_address]
+        UPSTREAMS.record_success(UPSTREAMS.get(server_address), rtt)
+        UPSTREAMS.record_lost_races(sent_at, server_address, answered_at)
+        logger.debug(
+            "Received %d bytes from %s in %.1fms", len(response_bytes), server_address, rtt * 1000
+        )
+        METRICS.emit(
+            "receive", hostname=hostname, query_id=query_id, upstream=server_address, rtt=rtt
+        )
+
+        if _is_truncated(response_bytes):
+            logger.debug("Response truncated, retrying over TCP...")
+            METRICS.inc("tcp_fallbacks")
+            response_bytes, query_id = TCP_POOL.query(server_address, query_bytes)
+            logger.debug("Received %d bytes over TCP from %s", len(response_bytes), server_address)
 
     except socket.timeout:
-        print(f"Error: Request timed out for {hostname}")
+        logger.warning("Request timed out for %s", hostname)
+        METRICS.inc("timeouts")
+        for address in sent_at:
+            UPSTREAMS.record_failure(UPSTREAMS.get(address))
         return None
     except socket.error as e:
-        print(f"Error: Socket error for {hostname}: {e}")
+        logger.warning("Socket error for %s: %s", hostname, e)
+        METRICS.inc("socket_errors")
+        UPSTREAMS.record_failure(primary)
         return None
     finally:
         if sock:
             sock.close()
 
     # --- 5. Parse Response ---
-    print(f"Parsing response for query ID {query_id}...")
-    ips, ttl = parse_dns_response(response_bytes, query_id)
+    logger.debug("Parsing response for query ID %s...", query_id)
+    return _parse_answer(hostname, query_type, response_bytes, query_id)
+
+
+def _parse_answer(hostname, query_type, response_bytes, query_id):
+    """parse_dns_answer() for the question we sent, plus the parse counters and hook."""
+    start = time.perf_counter()
+    answer = parse_dns_answer(response_bytes, query_id, hostname, query_type)
+    if answer is None:
+        METRICS.inc("parse_errors")
+    elif answer["negative"]:
+        METRICS.inc("negative_answers")
+    METRICS.emit(
+        "parse",
+        hostname=hostname,
+        query_id=query_id,
+        answer=answer,
+        duration=time.perf_counter() - start,
+    )
+    return answer
+
+
+def resolve(hostname, use_cache=True, cache=None, prefetch=None, query_type=TYPE_A):
+    """
+    Resolves a hostname to its records of query_type (IP addresses for the
+    default TYPE_A and for TYPE_AAAA) using manual DNS query and caching.
+    CNAME chains are followed, with each RRset cached on its own.
+    Names pinned in STATIC_HOSTS are answered from it before the cache.
+    'cache' defaults to the module-level DNS_CACHE. If the cache keeps stale
+    entries (stale_max_age > 0) and the upstream doesn't answer within
+    STALE_CLIENT_TIMEOUT, the expired IPs are returned instead. 'prefetch'
+    (default PREFETCH) refreshes hot entries in the background before they expire.
+    """
+    if cache is None:
+        cache = DNS_CACHE
+    if prefetch is None:
+        prefetch = PREFETCH
+    hostname = _normalize_name(hostname)
+
+    # --- 0. Check Static Hosts ---
+    static_ips = STATIC_HOSTS.lookup(hostname, query_type)
+    if static_ips is not None:
+        METRICS.inc("static_answers")
+        return static_ips or None
+
+    serve_stale = getattr(cache, "stale_max_age", 0) > 0
+    current_time = time.time()
+
+    # --- 1. Check Cache ---
+    if use_cache:
+        cache_entry = _cache_lookup(
+            cache, hostname, current_time, serve_stale, prefetch, query_type
+        )
+        if cache_entry is not None and cache_entry["expiry_time"] > current_time:
+            return cache_entry["ips"] or None  # Negative entries hold no IPs
+        if cache_entry is not None:
+            # Stale: give the upstream a short head start, then fall back to the old answer
+            refresh = _refresh_in_background(cache, hostname, query_type)
+            refresh.join(STALE_CLIENT_TIMEOUT)
+            if refresh.answer is not None:
+                return refresh.result
+            logger.debug("Serving stale IPs for %s: %s", hostname, cache_entry["ips"])
+            METRICS.inc("stale_answers")
+            return cache_entry["ips"] or None
+
+    answer = _query_upstream(hostname, query_type)
 
     # --- 6. Update Cache ---
-    if ips and ttl is not None and ttl > 0:
-        expiry_time = current_time + ttl
-        DNS_CACHE[hostname] = {"ips": ips, "expiry_time": expiry_time}
-        print(
-            f"Cached result for {hostname}: IPs={ips}, TTL={ttl}s (Expires at {time.ctime(expiry_time)})"
+    return _cache_store(cache, hostname, answer, current_time, query_type)
+
+
+def resolve_dual_stack(hostname, use_cache=True, cache=None):
+    """
+    Resolves both the IPv6 (AAAA) and IPv4 (A) addresses of hostname, sending
+    the two queries at the same time instead of one after the other.
+    Returns the IPv6 addresses followed by the IPv4 ones (the order RFC 8305
+    clients try them in), or None if neither lookup found anything.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        aaaa = executor.submit(resolve, hostname, use_cache, cache, None, TYPE_AAAA)
+        ipv4 = resolve(hostname, use_cache, cache, None, TYPE_A)
+        ipv6 = aaaa.result()
+    addresses = (ipv6 or []) + (ipv4 or [])
+    return addresses or None
+
+
+# --- Concurrent (asyncio) Resolution ---
+NEW_QUERY_ATTEMPTS = 64  # Random transaction IDs tried before a socket counts as full
+
+
+class _DNSDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Multiplexes many in-flight queries over one UDP socket.
+    Replies are matched to their waiting query by transaction ID.
+    """
+
+    def __init__(self):
+        self.transport = None
+        # { transaction_id: (Future resolved with (response, address), {address: send time}) }
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 2:
+            return
+        transaction_id = struct.unpack("!H", data[:2])[0]
+        pending = self.pending.get(transaction_id)
+        if pending is None or addr not in pending[1]:
+            return  # Not something we asked this server for
+        future = pending[0]
+        if not future.done():
+            future.set_result((data, addr))
+
+    def error_received(self, exc):
+        logger.warning("Socket error on batch socket: %s", exc)
+
+    def connection_lost(self, exc):
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("Socket closed."))
+
+    def new_query(self, hostname, query_type=TYPE_A):
+        """
+        Builds a query whose transaction ID is not already in flight on this
+        socket. Raises OSError if random picks keep landing on busy IDs, which
+        means the socket is close to all 65536 being in flight.
+        """
+        for _ in range(NEW_QUERY_ATTEMPTS):
+            query_bytes, query_id = build_dns_query(hostname, query_type)
+            if query_id not in self.pending:
+                return query_bytes, query_id
+        raise OSError("No free transaction ID (%d queries in flight)" % len(self.pending))
+
+
+async def _query_upstream_async(protocol, hostname, timeout, retries, query_type=TYPE_A):
+    """Async counterpart of _query_upstream(), shared by tasks asking for the same name."""
+    return await SINGLE_FLIGHT.do_async(
+        (hostname, query_type),
+        lambda: _send_query_async(protocol, hostname, timeout, retries, query_type),
+    )
+
+
+async def _send_query_async(protocol, hostname, timeout, retries, query_type=TYPE_A):
+    """
+    Async counterpart of _send_query(), retrying each timed-out attempt.
+    Each retry starts from the next upstream in the ranking, so one dead
+    server doesn't eat every attempt.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(retries + 1):
+        upstreams = UPSTREAMS.ranked()
+        primary = upstreams[attempt % len(upstreams)]
+        backup = None
+        if HEDGE_DELAY is not None and len(upstreams) > 1:
+            backup = upstreams[(attempt + 1) % len(upstreams)]
+
+        # A fresh transaction ID per attempt, so a late reply to an earlier
+        # attempt can't be mistaken for this one.
+        try:
+            query_bytes, query_id = protocol.new_query(hostname, query_type)
+        except OSError as e:
+            logger.warning("Socket error for %s: %s", hostname, e)
+            METRICS.inc("socket_errors")
+            return None
+        METRICS.emit("build", hostname=hostname, query_id=query_id, query=query_bytes)
+        future = loop.create_future()
+        sent_at = {}
+        protocol.pending[query_id] = (future, sent_at)
+        try:
+            start = time.monotonic()
+            sent_at[primary.address] = start
+            protocol.transport.sendto(query_bytes, primary.address)
+            METRICS.inc("upstream_queries")
+            METRICS.emit("send", hostname=hostname, query_id=query_id, upstream=primary.address)
+            if backup is not None:
+                await asyncio.wait({future}, timeout=min(HEDGE_DELAY, timeout))
+                if not future.done():
+                    logger.debug("Upstream slow for %s, racing %s...", hostname, backup.address[0])
+                    sent_at[backup.address] = time.monotonic()
+                    protocol.transport.sendto(query_bytes, backup.address)
+                    METRICS.inc("hedged_queries")
+                    METRICS.emit(
+                        "send", hostname=hostname, query_id=query_id, upstream=backup.address
+                    )
+            remaining = max(0, timeout - (time.monotonic() - start))
+            response_bytes, server_address = await asyncio.wait_for(future, remaining)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Request timed out for %s (attempt %d/%d)", hostname, attempt + 1, retries + 1
+            )
+            METRICS.inc("timeouts")
+            for address in sent_at:
+                UPSTREAMS.record_failure(UPSTREAMS.get(address))
+            continue
+        except OSError as e:
+            logger.warning("Socket error for %s: %s", hostname, e)
+            METRICS.inc("socket_errors")
+            return None
+        finally:
+            del protocol.pending[query_id]
+        answered_at = time.monotonic()
+        rtt = answered_at - sent_at[server_address]
+        UPSTREAMS.record_success(UPSTREAMS.get(server_address), rtt)
+        UPSTREAMS.record_lost_races(sent_at, server_address, answered_at)
+        METRICS.emit(
+            "receive", hostname=hostname, query_id=query_id, upstream=server_address, rtt=rtt
         )
-        return ips
-    elif ips:
-        # Got IPs but no valid TTL for caching
-        print(f"Resolved {hostname} to {ips} but could not cache (invalid TTL).")
-        return ips
-    else:
-        print(f"Failed to resolve {hostname}.")
-        return None
+        if _is_truncated(response_bytes):
+            logger.debug("Response truncated for %s, retrying over TCP...", hostname)
+            METRICS.inc("tcp_fallbacks")
+            try:
+                response_bytes, query_id = await loop.run_in_executor(
+                    None, TCP_POOL.query, server_address, query_bytes, timeout
+                )
+            except OSError as e:
+                logger.warning("TCP fallback failed for %s: %s", hostname, e)
+                return None
+        return _parse_answer(hostname, query_type, response_bytes, query_id)
+    return None
+
+
+async def resolve_many_async(
+    hostnames,
+    concurrency=100,
+    timeout=QUERY_TIMEOUT,
+    retries=2,
+    use_cache=True,
+    sockets=1,
+    cache=None,
+    query_type=TYPE_A,
+    dual_stack=False,
+):
+    """
+    Resolves many hostnames concurrently from inside a running event loop.
+    At most 'concurrency' queries are in flight at once, spread over 'sockets'
+    UDP sockets. With 'dual_stack' both AAAA and A are queried for every name
+    and the IPv6 addresses come first. Returns { hostname: ips or None }.
+    """
+    if cache is None:
+        cache = DNS_CACHE
+    # Transaction IDs are 16 bits, so more in-flight queries per socket than that can't be told apart.
+    concurrency = max(1, min(concurrency, 65536 * sockets))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    protocols = await _open_query_sockets(sockets)
+    options = (cache, use_cache, timeout, retries, semaphore)
+
+    async def lookup(index, hostname):
+        protocol = protocols[index % len(protocols)]
+        try:
+            if dual_stack:
+                return await _resolve_dual_stack_async(protocol, hostname, *options)
+            return await _resolve_async(protocol, hostname, query_type, *options)
+        except Exception as e:
+            # One bad name (e.g. one that can't be encoded) mustn't sink the whole batch
+            logger.warning("Lookup failed for %r: %s", hostname, e)
+            return None, False
+
+    unique_hostnames = list(dict.fromkeys(hostnames))  # Drop duplicates, keep order
+    try:
+        results = await asyncio.gather(
+            *(lookup(i, host) for i, host in enumerate(unique_hostnames))
+        )
+    finally:
+        for protocol in protocols:
+            protocol.transport.close()
+    return {host: ips for host, (ips, _) in zip(unique_hostnames, results)}
+
+
+async def resolve_stream_async(
+    hostnames,
+    concurrency=100,
+    timeout=QUERY_TIMEOUT,
+    retries=2,
+    use_cache=True,
+    sockets=1,
+    cache=None,
+    query_type=TYPE_A,
+    dual_stack=False,
+):
+    """
+    Resolves hostnames from any iterable, yielding
+    (hostname, ips or None, seconds taken, whether it was a cache hit, error)
+    as each lookup finishes, in completion order. 'error' is None unless the
+    lookup raised, e.g. for a name that can't be encoded; then it is the message. Hostnames are pulled from
+    the iterable only as lookup slots free up, so memory stays constant
+    however long the input is. Duplicates are not dropped.
+    """
+    if cache is None:
+        cache = DNS_CACHE
+    concurrency = max(1, min(concurrency, 65536 * sockets))
+    semaphore = asyncio.Semaphore(concurrency)
+    protocols = await _open_query_sockets(sockets)
+    options = (cache, use_cache, timeout, retries, semaphore)
+
+    async def timed_lookup(index, hostname):
+        protocol = protocols[index % len(protocols)]
+        start = time.perf_counter()
+        try:
+            if dual_stack:
+                ips, cached = await _resolve_dual_stack_async(protocol, hostname, *options)
+            else:
+                ips, cached = await _resolve_async(protocol, hostname, query_type, *options)
+        except Exception as e:
+            return hostname, None, time.perf_counter() - start, False, str(e)
+        return hostname, ips, time.perf_counter() - start, cached, None
+
+    hostnames = enumerate(hostnames)
+    pending = set()
+    try:
+        while True:
+            # Top up to 'concurrency' lookups, then hand back whichever finish first
+            for index, hostname in hostnames:
+                pending.add(asyncio.ensure_future(timed_lookup(index, hostname)))
+                if len(pending) >= concurrency:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        for protocol in protocols:
+            protocol.transport.close()
+
+
+async def _open_query_sockets(count):
+    """Opens 'count' multiplexed UDP sockets for upstream queries."""
+    loop = asyncio.get_running_loop()
+    protocols = []
+    for _ in range(count):
+        _, protocol = await loop.create_datagram_endpoint(
+            _DNSDatagramProtocol, family=socket.AF_INET, local_addr=("0.0.0.0", 0)
+        )
+        protocols.append(protocol)
+    return protocols
+
+
+async def _resolve_async(
+    protocol, hostname, query_type, cache, use_cache, timeout, retries, semaphore
+):
+    """
+    Async counterpart of resolve() that sends upstream queries on protocol,
+    at most as many at once as 'semaphore' allows.
+    Returns (ips or None, whether the answer came from the cache).
+    Static hosts count as cache hits.
+    """
+    hostname = _normalize_name(hostname)
+    static_ips = STATIC_HOSTS.lookup(hostname, query_type)
+    if static_ips is not None:
+        METRICS.inc("static_answers")
+        return static_ips or None, True
+    current_time = time.time()
+    cache_entry = None
+    if use_cache:
+        serve_stale = getattr(cache, "stale_max_age", 0) > 0
+        cache_entry = _cache_lookup(
+            cache, hostname, current_time, serve_stale, PREFETCH, query_type
+        )
+        if cache_entry is not None and cache_entry["expiry_time"] > current_time:
+            return cache_entry["ips"] or None, True  # Negative entries hold no IPs
+    async with semaphore:
+        answer = await _query_upstream_async(protocol, hostname, timeout, retries, query_type)
+    if answer is None and cache_entry is not None:
+        logger.debug("Serving stale IPs for %s: %s", hostname, cache_entry["ips"])
+        METRICS.inc("stale_answers")
+        return cache_entry["ips"] or None, False
+    return _cache_store(cache, hostname, answer, current_time, query_type), False
+
+
+async def _resolve_dual_stack_async(protocol, hostname, *options):
+    """Async counterpart of resolve_dual_stack(); 'options' as for _resolve_async()."""
+    # AAAA and A go out together rather than one after the other
+    (ipv6, ipv6_cached), (ipv4, ipv4_cached) = await asyncio.gather(
+        _resolve_async(protocol, hostname, TYPE_AAAA, *options),
+        _resolve_async(protocol, hostname, TYPE_A, *options),
+    )
+    return (ipv6 or []) + (ipv4 or []) or None, ipv6_cached and ipv4_cached
+
+
+def resolve_many(
+    hostnames,
+    concurrency=100,
+    timeout=QUERY_TIMEOUT,
+    retries=2,
+    use_cache=True,
+    sockets=1,
+    cache=None,
+    query_type=TYPE_A,
+    dual_stack=False,
+):
+    """
+    Resolves many hostnames at once, multiplexing queries over a small pool of
+    UDP sockets instead of opening one blocking socket per hostname.
+    Returns { hostname: ips or None }.
+    """
+    return asyncio.run(
+        resolve_many_async(
+            hostnames,
+            concurrency,
+            timeout,
+            retries,
+            use_cache,
+            sockets,
+            cache,
+            query_type,
+            dual_stack,
+        )
+    )
+
+
+# --- Caching Forwarder Server ---
+STALE_ANSWER_TTL = 30  # TTL given to clients on stale answers (RFC 8767)
+MAX_PLAIN_UDP_SIZE = 512  # Response limit for clients that don't send EDNS0
+FORWARDED_TYPES = (TYPE_A, TYPE_AAAA)  # Other query types get NOTIMP
+# Cache misses being forwarded at once per worker. Beyond this, e.g. during a
+# random-subdomain flood, misses get a stale answer or SERVFAIL straight away
+# instead of piling up tasks (and transaction IDs) behind a slow upstream.
+MAX_FORWARDED_IN_FLIGHT = 10000
+
+
+class _Forwarder:
+    """
+    Answers client A/AAAA queries from the static hosts and the cache and
+    forwards misses upstream over a shared multiplexed socket, using the same
+    lookup/store logic as resolve(). CNAME chains are flattened: clients get
+    the final addresses under the name they asked for.
+    """
+
+    def __init__(self, upstream_protocol, cache):
+        self.upstream_protocol = upstream_protocol
+        self.cache = cache
+        self.serve_stale = getattr(cache, "stale_max_age", 0) > 0
+        self.in_flight = 0  # Misses currently waiting on an upstream
+
+    def answer_from_cache(self, query_bytes, hostname, query_type, max_size):
+        """Returns a response for a fresh cache hit, or None if the query must be forwarded."""
+        hostname = _normalize_name(hostname)
+        static_ips = STATIC_HOSTS.lookup(hostname, query_type)
+        if static_ips is not None:
+            METRICS.inc("static_answers")
+            return self._response(query_bytes, static_ips, STATIC_TTL, RCODE_NOERROR, max_size)
+        current_time = time.time()
+        cache_entry = _cache_get_chain(self.cache, hostname, query_type, current_time)
+        if cache_entry is None:
+            return None
+        remaining_ttl = int(cache_entry["expiry_time"] - current_time)
+        return self._response(
+            query_bytes, cache_entry["ips"], remaining_ttl, cache_entry["rcode"], max_size
+        )
+
+    async def answer(self, query_bytes, max_size=None, cache_checked=False):
+        """
+        Returns the response bytes for a client query, or None to drop it.
+        'cache_checked' skips the cache lookup the caller already missed on.
+        """
+        try:
+            _, hostname, query_type, _ = parse_dns_query(query_bytes)
+        except ValueError:
+            return None  # Drop garbage rather than amplify it
+        if query_type not in FORWARDED_TYPES:
+            return build_dns_response(query_bytes, [], 0, RCODE_NOTIMP)
+        if not cache_checked:
+            response = self.answer_from_cache(query_bytes, hostname, query_type, max_size)
+            if response is not None:
+                return response
+
+        hostname = _normalize_name(hostname)
+        current_time = time.time()
+        stale_entry = None
+        if self.serve_stale:
+            stale_entry = _cache_get_chain(
+                self.cache, hostname, query_type, current_time, allow_stale=True
+            )
+        if self.in_flight >= MAX_FORWARDED_IN_FLIGHT:
+            METRICS.inc("overloaded")
+            answer = None
+        else:
+            self.in_flight += 1
+            try:
+                answer = await _query_upstream_async(
+                    self.upstream_protocol, hostname, QUERY_TIMEOUT, 1, query_type
+                )
+            finally:
+                self.in_flight -= 1
+        if answer is None:
+            if stale_entry is not None:
+                METRICS.inc("stale_answers")
+                return self._response(
+                    query_bytes,
+                    stale_entry["ips"],
+                    STALE_ANSWER_TTL,
+                    stale_entry["rcode"],
+                    max_size,
+                )
+            return build_dns_response(query_bytes, [], 0, RCODE_SERVFAIL)
+        _cache_store(self.cache, hostname, answer, current_time, query_type)
+        return self._response(
+            query_bytes, answer["ips"], answer["ttl"] or 0, answer["rcode"], max_size
+        )
+
+    @staticmethod
+    def _response(query_bytes, ips, ttl, rcode, max_size):
+        response = build_dns_response(query_bytes, ips, ttl, rcode)
+        if max_size is not None and len(response) > max_size:
+            # Too big for this client's datagrams: tell it to come back over TCP
+            response = build_dns_response(query_bytes, [], 0, rcode, truncated=True)
+        return response
+
+
+class _ForwarderUDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # Clients that sent an EDNS0 OPT record (ARCOUNT > 0) can take bigger answers
+        max_size = EDNS_UDP_PAYLOAD if data[10:12] != b"\x00\x00" else MAX_PLAIN_UDP_SIZE
+        # Hot path: answer cache hits right here, without creating a task
+        try:
+            _, hostname, query_type, _ = parse_dns_query(data)
+        except ValueError:
+            return
+        cacheable = query_type in FORWARDED_TYPES
+        if cacheable:
+            response = self.forwarder.answer_from_cache(data, hostname, query_type, max_size)
+            if response is not None:
+                self.transport.sendto(response, addr)
+                return
+        asyncio.ensure_future(self._answer_later(data, addr, max_size, cacheable))
+
+    async def _answer_later(self, data, addr, max_size, cache_checked):
+        response = await self.forwarder.answer(data, max_size, cache_checked)
+        if response is not None:
+            self.transport.sendto(response, addr)
+
+
+async def _handle_tcp_client(forwarder, reader, writer):
+    """Answers length-prefixed queries on one TCP connection until the client closes it."""
+    try:
+        while True:
+            prefix = await reader.readexactly(2)
+            query_bytes = await reader.readexactly(struct.unpack("!H", prefix)[0])
+            response = await forwarder.answer(query_bytes)
+            if response is not None:
+                writer.write(struct.pack("!H", len(response)) + response)
+                await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def _reuseport_socket(kind, host, port):
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        # Lets every worker process bind the same port; the kernel spreads queries across them
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+async def _serve_async(host, port, cache):
+    loop = asyncio.get_running_loop()
+    _, upstream_protocol = await loop.create_datagram_endpoint(
+        _DNSDatagramProtocol, family=socket.AF_INET, local_addr=("0.0.0.0", 0)
+    )
+    forwarder = _Forwarder(upstream_protocol, cache)
+    await loop.create_datagram_endpoint(
+        lambda: _ForwarderUDPProtocol(forwarder),
+        sock=_reuseport_socket(socket.SOCK_DGRAM, host, port),
+    )
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle_tcp_client(forwarder, reader, writer),
+        sock=_reuseport_socket(socket.SOCK_STREAM, host, port),
+    )
+    # SIGTERM stops the worker cleanly, so whatever follows (e.g. a final snapshot) still runs
+    stopped = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopped.set)
+    # SIGHUP re-reads the static hosts in a thread; queries keep using the old index meanwhile
+    loop.add_signal_handler(
+        signal.SIGHUP, lambda: loop.run_in_executor(None, reload_static_hosts)
+    )
+    logger.info("Worker %d serving DNS on %s:%s (UDP and TCP)", os.getpid(), host, port)
+    async with server:
+        await stopped.wait()
+
+
+def _serve_worker(host, port, upstreams, snapshot=None, index=0, workers=1):
+    if upstreams:
+        set_upstreams(upstreams)
+    save_snapshot = None
+    if snapshot and workers > 1:
+        # Each worker saves its own shard but warms up from all of them, since
+        # SO_REUSEPORT may send a client to a different worker after a restart
+        shards = [f"{snapshot}.{i}" for i in range(workers)]
+        save_snapshot = enable_snapshots(shards[index], load_from=shards)
+    elif snapshot:
+        save_snapshot = enable_snapshots(snapshot)
+    try:
+        asyncio.run(_serve_async(host, port, DNS_CACHE))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Worker processes exit without running atexit hooks, so save here
+        if save_snapshot is not None:
+            save_snapshot()
+            atexit.unregister(save_snapshot)
+
+
+def serve(host="127.0.0.1", port=5353, workers=1, upstreams=None, snapshot=None):
+    """
+    Runs a local caching DNS forwarder on host:port (UDP and TCP). Queries are
+    answered from the cache and misses are forwarded to the upstream servers.
+    With workers > 1, that many processes share the port via SO_REUSEPORT,
+    each with its own cache. With a 'snapshot' path, the cache starts from
+    that snapshot and keeps it up to date (see enable_snapshots()); multiple
+    workers each keep a '<snapshot>.<worker index>' shard. Names loaded into
+    STATIC_HOSTS beforehand are served too, and SIGHUP reloads them.
+    Blocks until interrupted.
+    """
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        logger.warning("SO_REUSEPORT is not available here, running a single worker.")
+        workers = 1
+    if workers == 1:
+        _serve_worker(host, port, upstreams, snapshot)
+        return
+
+    processes = [
+        multiprocessing.Process(
+            target=_serve_worker,
+            args=(host, port, upstreams, snapshot, index, workers),
+            daemon=True,
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # Turn SIGTERM into SystemExit so the workers get stopped below too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Pass SIGHUP (reload the static hosts) on to every worker
+    signal.signal(
+        signal.SIGHUP,
+        lambda signum, frame: [os.kill(process.pid, signal.SIGHUP) for process in processes],
+    )
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+def _parse_upstreams(servers):
+    """['IP[:PORT]', ...] -> [(ip, port), ...] for the --upstream options."""
+    upstreams = []
+    for server in servers:
+        ip, _, server_port = server.partition(":")
+        upstreams.append((ip, int(server_port or DNS_PORT)))
+    return upstreams
+
+
+def _add_static_hosts_arguments(parser):
+    parser.add_argument(
+        "--hosts",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="Hosts file of names to answer without network I/O (repeatable).",
+    )
+    parser.add_argument(
+        "--zone",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="Zone file of A/AAAA records to answer without network I/O (repeatable).",
+    )
+
+
+def serve_main(argv):
+    """Command line entry point for 'python dns_resolver.py serve ...'."""
+    parser = argparse.ArgumentParser(
+        prog="dns_resolver.py serve", description="Run a local caching DNS forwarder."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5353)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--upstream",
+        action="append",
+        metavar="IP[:PORT]",
+        help="Upstream server (repeatable). Defaults to UPSTREAM_SERVERS.",
+    )
+    parser.add_argument(
+        "--snapshot",
+        metavar="PATH",
+        help="Cache snapshot file loaded at startup and saved periodically and at exit.",
+    )
+    _add_static_hosts_arguments(parser)
+    args = parser.parse_args(argv)
+    load_static_hosts(args.hosts, args.zone)
+
+    upstreams = _parse_upstreams(args.upstream) if args.upstream else None
+    serve(args.host, args.port, args.workers, upstreams, args.snapshot)
+
+
+# --- Bulk Resolution CLI ---
+# Finer than LATENCY_BUCKETS at the low end, where cache hits land
+BULK_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005) + LATENCY_BUCKETS
+
+
+def _read_hostnames(lines):
+    """Yields the first field of every non-blank, non-comment line."""
+    for line in lines:
+        fields = line.split("#", 1)[0].split()
+        if fields:
+            yield fields[0]
+
+
+async def _bulk_resolve(lines, output, args):
+    """Streams lookups for bulk_main() and returns the summary counters."""
+    latency = Histogram(BULK_LATENCY_BUCKETS)
+    summary = {"resolved": 0, "failed": 0, "errors": 0, "cache_hits": 0}
+    results = resolve_stream_async(
+        _read_hostnames(lines),
+        concurrency=args.concurrency,
+        timeout=args.timeout,
+        retries=args.retries,
+        use_cache=not args.no_cache,
+        sockets=args.sockets,
+        query_type=TYPE_AAAA if args.type == "AAAA" else TYPE_A,
+        dual_stack=args.type == "both",
+    )
+    async for hostname, ips, seconds, cached, error in results:
+        latency.observe(seconds)
+        summary["resolved" if ips else "failed"] += 1
+        summary["cache_hits"] += cached
+        record = {"name": hostname, "ips": ips, "ms": round(seconds * 1000, 3)}
+        if error is not None:
+            summary["errors"] += 1
+            record["error"] = error
+        output.write(json.dumps(record) + "\n")
+    summary["latency"] = latency
+    return summary
+
+
+def bulk_main(argv):
+    """
+    Command line entry point for 'python dns_resolver.py bulk ...'.
+    Streams hostnames (one per line) from a file or stdin, writes one JSON
+    line per result as it finishes and a summary to stderr at the end.
+    """
+    parser = argparse.ArgumentParser(
+        prog="dns_resolver.py bulk",
+        description="Resolve a list of hostnames, writing JSON lines as they finish.",
+    )
+    parser.add_argument(
+        "input", nargs="?", default="-", help="File with one hostname per line (default: stdin)."
+    )
+    parser.add_argument("--output", "-o", default="-", help="JSON lines file (default: stdout).")
+    parser.add_argument("--concurrency", "-c", type=int, default=500)
+    parser.add_argument("--type", choices=("A", "AAAA", "both"), default="A")
+    parser.add_argument("--timeout", type=float, default=QUERY_TIMEOUT)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--sockets", type=int, default=4)
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument(
+        "--upstream",
+        action="append",
+        metavar="IP[:PORT]",
+        help="Upstream server (repeatable). Defaults to UPSTREAM_SERVERS.",
+    )
+    _add_static_hosts_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.upstream:
+        set_upstreams(_parse_upstreams(args.upstream))
+    load_static_hosts(args.hosts, args.zone)
+
+    lines = sys.stdin if args.input == "-" else open(args.input)
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    start = time.perf_counter()
+    try:
+        summary = asyncio.run(_bulk_resolve(lines, output, args))
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+
+    latency = summary["latency"]
+    total = latency.count
+    print(f"Resolved {summary['resolved']}/{total} names in {elapsed:.2f}s", file=sys.stderr)
+    print(f"  {total / elapsed if elapsed else 0:,.0f} queries/s", file=sys.stderr)
+    print(
+        f"  latency p50 <= {latency.quantile(0.5) * 1000:g}ms,"
+        f" p99 <= {latency.quantile(0.99) * 1000:g}ms",
+        file=sys.stderr,
+    )
+    print(
+        f"  cache hit ratio {summary['cache_hits'] / total if total else 0:.1%},"
+        f" failures {summary['failed']} ({summary['errors']} could not be queried)",
+        file=sys.stderr,
+    )
 
 
 # --- Main Execution Example ---
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        serve_main(sys.argv[2:])
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == "bulk":
+        # Individual timeouts are retried and counted in the summary, so only show errors
+        logging.basicConfig(level=logging.ERROR, format="%(message)s")
+        bulk_main(sys.argv[2:])
+        sys.exit()
+
+    # Show the resolver's step-by-step tracing for the demo
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+
     host_to_resolve = "www.google.com"
     if len(sys.argv) > 1:
         host_to_resolve = sys.argv[1]
@@ -337,8 +2754,11 @@ if __name__ == "__main__":
     print("-" * 20)
 
     # Example to test TTL expiry (if TTL is short enough)
-    if result1 and host_to_resolve in DNS_CACHE:
-        ttl_value = DNS_CACHE[host_to_resolve]["expiry_time"] - time.time()
+    cache_entry = _cache_get_chain(
+        DNS_CACHE, _normalize_name(host_to_resolve), TYPE_A, time.time()
+    )
+    if result1 and cache_entry is not None:
+        ttl_value = cache_entry["expiry_time"] - time.time()
         print(f"Cached TTL is approx {ttl_value:.0f}s. Waiting for slightly longer...")
         if ttl_value < 60:  # Only wait if TTL is reasonably short
             wait_time = ttl_value + 2
@@ -360,5 +2780,19 @@ if __name__ == "__main__":
         print(f"Resolved IPs: {result4}")
     print("-" * 20)
 
+    print(f"--- Resolving {host_to_resolve} over IPv6 and IPv4 at once ---")
+    print(f"Resolved IPs: {resolve_dual_stack(host_to_resolve)}")
+    print("-" * 20)
+
+    print("--- Resolving several hosts concurrently ---")
+    batch_results = resolve_many(["github.com", "python.org", "wikipedia.org"])
+    for host, ips in batch_results.items():
+        print(f"{host}: {ips}")
+    print("-" * 20)
+
     print("--- Cache contents ---")
     print(DNS_CACHE)
+    print("-" * 20)
+
+    print("--- Metrics ---")
+    print(METRICS.prometheus_text())
@@ -0,0 +1,177 @@
+"""
+Minimal local DNS server for exercising dns_resolver.py without the network.
+
+Every A query is answered with the same fixed IPs (AAAA queries with the
+fixed IPv6 addresses) after an optional
+artificial delay, so several stubs with different delays can stand in for
+fast, slow and dead upstreams. The same port also accepts DNS over TCP, and
+with truncate=True every UDP answer comes back with the TC flag set so the
+resolver's TCP fallback gets exercised. 'loss' drops that fraction of UDP
+queries, and 'compression' is the fraction of answer names sent as pointers
+to the question name (the rest spell the name out in full).
+
+Usage: python stub_server.py
+    Starts a fast and a slow stub and shows the resolver preferring the fast
+    one, then racing a second query when the preferred one becomes slow.
+"""
+
+import random
+import socket
+import struct
+import threading
+import time
+
+import dns_resolver
+from dns_resolver import (
+    TYPE_AAAA,
+    build_dns_response,
+    encode_dns_name,
+    parse_dns_query,
+)
+
+
+class StubDNSServer:
+    """UDP DNS server on localhost that answers A/AAAA queries with scripted IPs."""
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        delay=0.0,
+        ips=("10.0.0.1",),
+        ttl=300,
+        truncate=False,
+        ipv6s=("fd00::1",),
+        loss=0.0,
+        compression=1.0,
+    ):
+        self.delay = delay  # Seconds to wait before answering; None = never answer
+        self.ips = list(ips)
+        self.ipv6s = list(ipv6s)
+        self.loss = loss
+        self.compression = compression
+        self.dropped = 0
+        self.ttl = ttl
+        self.truncate = truncate
+        self.queries = 0
+        self.tcp_queries = 0
+        self.tcp_connections = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_sock.bind(self.address)
+        self.tcp_sock.listen()
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+        threading.Thread(target=self._serve_tcp, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.sock.close()
+        self.tcp_sock.close()
+
+    def _serve(self):
+        while True:
+            try:
+                query, client = self.sock.recvfrom(512)
+            except OSError:
+                return  # Socket closed by stop()
+            self.queries += 1
+            if self.delay is None:
+                continue
+            if self.loss and random.random() < self.loss:
+                self.dropped += 1
+                continue
+            response = self.build_response(query, truncated=self.truncate)
+            if self.delay:
+                # Delay each answer on its own timer so slow answers don't queue up
+                threading.Timer(self.delay, self._reply, (response, client)).start()
+            else:
+                self._reply(response, client)
+
+    def _reply(self, response, client):
+        try:
+            self.sock.sendto(response, client)
+        except OSError:
+            pass
+
+    def _serve_tcp(self):
+        while True:
+            try:
+                conn, _ = self.tcp_sock.accept()
+            except OSError:
+                return
+            self.tcp_connections += 1
+            threading.Thread(target=self._handle_tcp, args=(conn,), daemon=True).start()
+
+    def _handle_tcp(self, conn):
+        """Answers length-prefixed queries on one connection until the client closes it."""
+        with conn:
+            reader = conn.makefile("rb")
+            while True:
+                prefix = reader.read(2)
+                if len(prefix) < 2:
+                    return
+                query = reader.read(struct.unpack("!H", prefix)[0])
+                self.tcp_queries += 1
+                response = self.build_response(query)
+                conn.sendall(struct.pack("!H", len(response)) + response)
+
+    def build_response(self, query, truncated=False):
+        """
+        Answers the query's question with self.ips (self.ipv6s for AAAA), using a
+        pointer to the question name. A truncated response has the TC flag and no answers.
+        """
+        _, hostname, query_type, question_end = parse_dns_query(query)
+        ips = self.ipv6s if query_type == TYPE_AAAA else self.ips
+        response = build_dns_response(query, ips, self.ttl, truncated=truncated)
+        if self.compression >= 1.0 or truncated or not ips:
+            return response
+        # Swap the leading answers' 2-byte pointers for the full question name
+        full_name = encode_dns_name(hostname)
+        answer_size = (len(response) - question_end) // len(ips)
+        expanded = round(len(ips) * (1.0 - self.compression))
+        answers = []
+        for i in range(len(ips)):
+            start = question_end + i * answer_size
+            answer = response[start : start + answer_size]
+            answers.append(full_name + answer[2:] if i < expanded else answer)
+        return response[:question_end] + b"".join(answers)
+
+
+if __name__ == "__main__":
+    fast = StubDNSServer(delay=0.005, ips=["10.0.0.1"]).start()
+    slow = StubDNSServer(delay=0.3, ips=["10.0.0.2"]).start()
+    dns_resolver.set_upstreams([slow.address, fast.address])
+
+    print("--- Latency-aware selection ---")
+    for i in range(6):
+        start = time.perf_counter()
+        ips = dns_resolver.resolve(f"host{i}.example", use_cache=False)
+        print(f"host{i}: {ips} in {(time.perf_counter() - start) * 1000:.1f}ms")
+    print(dns_resolver.UPSTREAMS.ranked())
+    print("-" * 20)
+
+    print("--- Racing a slow upstream ---")
+    fast.delay = 0.5  # The preferred server suddenly becomes slow
+    dns_resolver.HEDGE_DELAY = 0.05
+    start = time.perf_counter()
+    ips = dns_resolver.resolve("raced.example", use_cache=False)
+    print(f"raced: {ips} in {(time.perf_counter() - start) * 1000:.1f}ms")
+    print(dns_resolver.UPSTREAMS.ranked())
+    print("-" * 20)
+
+    print("--- TCP fallback for truncated answers ---")
+    big = StubDNSServer(ips=[f"10.1.0.{i}" for i in range(1, 101)], truncate=True).start()
+    dns_resolver.set_upstreams([big.address])
+    dns_resolver.HEDGE_DELAY = None
+    results = dns_resolver.resolve_many([f"big{i}.example" for i in range(20)])
+    print(f"Resolved {sum(len(ips) for ips in results.values())} records")
+    print(f"TCP queries: {big.tcp_queries} over {big.tcp_connections} connection(s)")
+
+    fast.stop()
+    slow.stop()
+    big.stop()
@@ -1,21 +1,178 @@
-from flask import Flask, redirect, render_template, request
+from flask import (
+    Flask,
+    Response,
+    abort,
+    g,
+    has_request_context,
+    jsonify,
+    make_response,
+    redirect,
+    render_template,
+    request,
+    stream_template,
+    stream_with_context,
+)
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import case, delete as sql_delete, event, insert, tuple_, update as sql_update
+from sqlalchemy.exc import IntegrityError, OperationalError
+from collections import Counter, OrderedDict
 from datetime import datetime
+import bisect
+import csv
+import io
+import json
+import os
+import threading
+import time
+import zlib
+
+# Database settings per profile, picked with the TASKS_DB_PROFILE environment
+# variable. "production" is for running under several threads or processes
+# (e.g. gunicorn workers): WAL lets readers carry on while a write commits,
+# and busy_timeout makes writers wait for the lock instead of failing with
+# "database is locked".
+DB_PROFILES = {
+    "development": {
+        "SQLITE_PRAGMAS": {},
+        "SQLALCHEMY_ENGINE_OPTIONS": {},
+    },
+    "production": {
+        "SQLITE_PRAGMAS": {
+            "journal_mode": "WAL",
+            "busy_timeout": 5000,  # Milliseconds to wait for a lock
+            "synchronous": "NORMAL",  # Safe with WAL; fsyncs at checkpoints only
+            "cache_size": -20000,  # Negative = KiB, so ~20 MB of page cache
+            "temp_store": "MEMORY",
+        },
+        "SQLALCHEMY_ENGINE_OPTIONS": {
+            "pool_size": 10,
+            "max_overflow": 10,
+            "pool_timeout": 10,
+            # Connections are handed between request threads by the pool
+            "connect_args": {"check_same_thread": False, "timeout": 5},
+        },
+    },
+}
 
 app = Flask(__name__)
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///test.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///test.db")
+db_profile = os.environ.get("TASKS_DB_PROFILE", "development")
+if db_profile not in DB_PROFILES:
+    raise RuntimeError(
+        "Unknown TASKS_DB_PROFILE %r; use one of: %s" % (db_profile, ", ".join(DB_PROFILES))
+    )
+app.config.from_mapping(DB_PROFILES[db_profile])
 db = SQLAlchemy(app)
 
+# Tasks per page on the index; ?per_page= can ask for up to MAX_PER_PAGE
+PER_PAGE = 50
+MAX_PER_PAGE = 500
+# Ids per "id IN (...)" clause, well under SQLite's bound-parameter limit
+ID_CHUNK_SIZE = 500
+# Rendered index pages kept in memory (one per cursor/page size combination)
+PAGE_CACHE_SIZE = 256
+# The /all page fetches tasks this many at a time while it renders them, and
+# sends the HTML in chunks of about STREAM_CHUNK_SIZE characters
+STREAM_BATCH_SIZE = 500
+STREAM_CHUNK_SIZE = 16384
+# Matches per page on the search results
+SEARCH_PER_PAGE = 20
+# Rows fetched per round trip by the export endpoints and inserted per
+# statement by the import endpoint, so neither holds the whole table in memory
+EXPORT_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 1000
+MAX_IMPORT_ERRORS = 100  # Bad rows listed in an import's response; the rest are only counted
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SLOW_QUERY_SECONDS = 0.1  # Statements slower than this are logged and counted
+# The same statement run this many times in one request is flagged as N+1
+N_PLUS_ONE_THRESHOLD = 10
+
+# Full-text index over Todo.content. It is an external-content FTS5 table:
+# it stores only the index and reads the text from 'todo' by rowid, and the
+# triggers keep it in step with every insert, update and delete (including
+# the bulk API's Core statements, which ORM events would miss).
+SEARCH_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS todo_fts
+       USING fts5(content, content='todo', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS todo_fts_insert AFTER INSERT ON todo BEGIN
+         INSERT INTO todo_fts(rowid, content) VALUES (new.id, new.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS todo_fts_delete AFTER DELETE ON todo BEGIN
+         INSERT INTO todo_fts(todo_fts, rowid, content) VALUES ('delete', old.id, old.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS todo_fts_update AFTER UPDATE OF content ON todo BEGIN
+         INSERT INTO todo_fts(todo_fts, rowid, content) VALUES ('delete', old.id, old.content);
+         INSERT INTO todo_fts(rowid, content) VALUES (new.id, new.content);
+       END""",
+]
+
 
 class Todo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.String(200), nullable=False)
     date_created = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Pages are read in (date_created, id) order, so one index covers both
+    # the ordering and the "rows after this cursor" lookup
+    __table_args__ = (db.Index("ix_todo_date_created_id", "date_created", "id"),)
+
     def __repr__(self):
         return "<Task %r>" % self.id
 
+    @property
+    def cursor(self):
+        """Position of this task in the list, as used by ?after= and ?before=."""
+        return "%s_%d" % (self.date_created.isoformat(), self.id)
+
+
+class PageVersion(db.Model):
+    """
+    A single row counting writes to the task list, bumped in the same
+    transaction as every write. Each request reads it, so cached pages, ETags
+    and Last-Modified stay correct however many worker processes serve the app.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified = db.Column(db.Integer, nullable=False)  # Unix seconds of the last write
+
+
+def parse_cursor(cursor):
+    """Turns a Todo.cursor string back into a (date_created, id) tuple."""
+    try:
+        date_created, task_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(date_created), int(task_id)
+    except ValueError:
+        abort(400)
+
+
+def get_page(after=None, before=None, per_page=PER_PAGE):
+    """
+    Keyset pagination: returns (tasks, has_prev, has_next) for the page after
+    (or before) the given cursor. Seeking with the cursor instead of an
+    OFFSET means every page costs the same however deep into the list it is.
+    """
+    key = tuple_(Todo.date_created, Todo.id)
+    query = Todo.query
+    if before is not None:
+        query = query.filter(key < tuple_(*parse_cursor(before)))
+        query = query.order_by(Todo.date_created.desc(), Todo.id.desc())
+    else:
+        if after is not None:
+            query = query.filter(key > tuple_(*parse_cursor(after)))
+        query = query.order_by(Todo.date_created, Todo.id)
+
+    # One extra row tells whether there is another page in this direction
+    tasks = query.limit(per_page + 1).all()
+    more = len(tasks) > per_page
+    tasks = tasks[:per_page]
+    if before is not None:
+        tasks.reverse()
+        return tasks, more, True
+    return tasks, after is not None, more
+
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -25,13 +182,149 @@ def index():
 
         try:
             db.session.add(new_task)
+            page_cache.invalidate()
             db.session.commit()
             return redirect("/")
-        except:
+        except Exception:
+            db.session.rollback()
             return "Something went wrong. Failed to create task."
     else:
-        tasks = Todo.query.order_by(Todo.date_created).all()
-        return render_template("index.html", tasks=tasks)
+        per_page = request.args.get("per_page", PER_PAGE, type=int)
+        per_page = max(1, min(per_page, MAX_PER_PAGE))
+        after, before = request.args.get("after"), request.args.get("before")
+        key = (after, before, per_page)
+        version, last_modified = page_cache.current()
+        etag = page_cache.etag(key, version, last_modified)
+
+        # An ETag match takes precedence over the date, as in RFC 9110
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            since = request.if_modified_since
+            not_modified = since is not None and last_modified <= since.replace(tzinfo=None)
+        if not_modified:
+            page_cache.not_modified += 1
+            response = make_response("", 304)
+        else:
+            html = page_cache.get(key, version)
+            if html is None:
+                tasks, has_prev, has_next = get_page(after, before, per_page)
+                html = render_template(
+                    "index.html",
+                    tasks=tasks,
+                    has_prev=has_prev,
+                    has_next=has_next,
+                    per_page=per_page,
+                )
+                page_cache.set(key, html, version)
+            response = make_response(html)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # Let clients and proxies keep the page, but always check back first
+        response.cache_control.no_cache = True
+        return response
+
+
+def match_query(text):
+    """
+    Turns what the user typed into an FTS5 query: every word must appear,
+    the last one may be a prefix, and quoting keeps FTS5 operators and
+    punctuation in the input from being parsed as query syntax.
+    """
+    words = ['"%s"' % word.replace('"', '""') for word in text.split()]
+    if words:
+        words[-1] += "*"
+    return " ".join(words)
+
+
+def like_pattern(word):
+    """'50%_off' -> '%50\\%\\_off%': matches the word anywhere, taken literally."""
+    escaped = word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return "%" + escaped + "%"
+
+
+def uses_fts():
+    # todo_fts is only created on SQLite (see create_schema)
+    return db.engine.dialect.name == "sqlite"
+
+
+@app.route("/search")
+def search():
+    text = request.args.get("q", "").strip()
+    page = max(1, request.args.get("page", 1, type=int))
+    tasks, has_next = [], False
+    # One extra row tells if there is a next page
+    limit, offset = SEARCH_PER_PAGE + 1, (page - 1) * SEARCH_PER_PAGE
+    if text and uses_fts():
+        # bm25() ranks better matches lower
+        statement = db.text(
+            "SELECT todo.* FROM todo_fts JOIN todo ON todo.id = todo_fts.rowid"
+            " WHERE todo_fts MATCH :query ORDER BY bm25(todo_fts)"
+            " LIMIT :limit OFFSET :offset"
+        )
+        tasks = (
+            db.session.execute(
+                db.select(Todo).from_statement(statement),
+                {"query": match_query(text), "limit": limit, "offset": offset},
+            )
+            .scalars()
+            .all()
+        )
+    elif text:
+        # Other databases have no FTS5 table: every word must appear somewhere
+        # in the content, newest first. A table scan, and unranked, but correct.
+        query = db.select(Todo)
+        for word in text.split():
+            query = query.where(Todo.content.ilike(like_pattern(word), escape="\\"))
+        query = query.order_by(Todo.date_created.desc(), Todo.id.desc())
+        tasks = db.session.scalars(query.limit(limit).offset(offset)).all()
+    has_next = len(tasks) > SEARCH_PER_PAGE
+    tasks = tasks[:SEARCH_PER_PAGE]
+    return render_template(
+        "search.html", q=text, tasks=tasks, page=page, has_next=has_next
+    )
+
+
+def chunked(pieces, size=STREAM_CHUNK_SIZE):
+    """
+    Joins the many small strings a streamed template yields into chunks of
+    about 'size' characters, so the response isn't sent a few bytes at a time.
+    """
+    buffer, buffered = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield "".join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+@app.route("/all")
+def all_tasks():
+    """
+    Every task on one page. The template is streamed while the query is
+    still being read, STREAM_BATCH_SIZE rows at a time, so the top of the
+    page reaches the browser straight away and memory use doesn't grow with
+    the number of tasks.
+    """
+
+    def tasks():
+        # Queried once the template reaches the table, inside the streamed
+        # response: the view's own session is closed as soon as it returns
+        yield from db.session.scalars(
+            db.select(Todo)
+            .order_by(Todo.date_created, Todo.id)
+            .execution_options(yield_per=STREAM_BATCH_SIZE)
+        )
+
+    return Response(chunked(stream_template("all.html", tasks=tasks())), mimetype="text/html")
+
+
+@app.route("/api/cache-stats")
+def cache_stats():
+    return jsonify(page_cache.stats())
 
 
 @app.route("/delete/<int:id>")
@@ -40,9 +333,11 @@ def delete(id):
 
     try:
         db.session.delete(task_to_delete)
+        page_cache.invalidate()
         db.session.commit()
         return redirect("/")
-    except:
+    except Exception:
+        db.session.rollback()
         return "Something went wrong. Failed to delete task."
 
 
@@ -55,11 +350,588 @@ def update(id):
     else:
         task_to_update.content = request.form["content"]
         try:
+            page_cache.invalidate()
             db.session.commit()
             return redirect("/")
-        except:
+        except Exception:
+            db.session.rollback()
             return "Something went wrong. Failed to update task."
 
 
+class PageCache:
+    """
+    Rendered index pages, each stored with the PageVersion it was rendered at.
+
+    Every write bumps the shared version, which is also part of each page's
+    ETag, so clients holding a page from before the write get a fresh one
+    while everyone else gets 304 Not Modified without a render. Pages are
+    cached per process, but the version lives in the database, so a write
+    made by any worker is seen by all of them on their next request.
+    """
+
+    def __init__(self, max_size=PAGE_CACHE_SIZE):
+        self.max_size = max_size
+        self.pages = OrderedDict()  # { (after, before, per_page): (version, html) }, LRU first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def current(self):
+        """Returns the shared (version, last modified datetime)."""
+        version, modified = db.session.execute(
+            db.select(PageVersion.version, PageVersion.modified).where(PageVersion.id == 1)
+        ).one()
+        return version, datetime.utcfromtimestamp(modified)
+
+    def etag(self, key, version, last_modified):
+        # The date tells apart version numbers reused by a recreated database
+        return "%d-%s-%x" % (
+            version,
+            last_modified.strftime("%Y%m%d%H%M%S"),
+            zlib.crc32(repr(key).encode()),
+        )
+
+    def get(self, key, version):
+        with self.lock:
+            cached = self.pages.get(key)
+            if cached is None or cached[0] != version:
+                self.misses += 1
+                return None
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+
+    def set(self, key, html, version):
+        with self.lock:
+            self.pages[key] = (version, html)
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_size:
+                self.pages.popitem(last=False)
+
+    def invalidate(self):
+        """
+        Bumps the shared version. Call it in the write's transaction, before
+        the commit, so the version changes exactly when the tasks do.
+        """
+        now = int(time.time())
+        db.session.execute(
+            sql_update(PageVersion)
+            .where(PageVersion.id == 1)
+            .values(
+                version=PageVersion.version + 1,
+                # HTTP dates have whole seconds, so step at least one second past
+                # the previous value or a client could miss a write made within it
+                modified=case(
+                    (PageVersion.modified + 1 > now, PageVersion.modified + 1), else_=now
+                ),
+            )
+        )
+
+    def stats(self):
+        version = self.current()[0]
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.pages),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "not_modified": self.not_modified,
+                "version": version,
+            }
+
+
+page_cache = PageCache()
+
+
+def chunks(items, size=ID_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def check_content(op):
+    """Returns the error message for a create/update op's content, or None."""
+    content = op.get("content")
+    if not isinstance(content, str) or not content:
+        return "content must be a non-empty string"
+    if len(content) > Todo.content.type.length:
+        return "content is longer than %d characters" % Todo.content.type.length
+    return None
+
+
+@app.route("/api/tasks/bulk", methods=["POST"])
+def bulk_tasks():
+    """
+    Applies an array of operations in one transaction:
+        {"op": "create", "content": "..."}
+        {"op": "update", "id": 1, "content": "..."}
+        {"op": "delete", "id": 1}
+    The body is either that array or {"operations": [...]}. Invalid items are
+    reported and skipped; the rest are applied as one bulk INSERT, one bulk
+    UPDATE and chunked DELETEs (in that order), so updates and deletes can
+    only refer to tasks that existed before the request, and updating a task
+    that the same request deletes is reported as a conflict. Returns one
+    result per item.
+    """
+    body = request.get_json(silent=True)
+    ops = body.get("operations") if isinstance(body, dict) else body
+    if not isinstance(ops, list):
+        return jsonify(error="expected a JSON array of operations"), 400
+
+    results = [None] * len(ops)
+    creates, updates, deletes = [], [], []
+    for i, op in enumerate(ops):
+        kind = op.get("op") if isinstance(op, dict) else None
+        error = None
+        task_id = op.get("id") if isinstance(op, dict) else None
+        # bool is a subclass of int, but true/false are not ids
+        if kind in ("update", "delete") and (
+            not isinstance(task_id, int) or isinstance(task_id, bool)
+        ):
+            error = "id must be an integer"
+        elif kind in ("create", "update"):
+            error = check_content(op)
+        elif kind != "delete":
+            error = "op must be create, update or delete"
+        if error:
+            results[i] = {"status": "error", "error": error}
+        elif kind == "create":
+            creates.append(i)
+        elif kind == "update":
+            updates.append(i)
+        else:
+            deletes.append(i)
+
+    # Look up every id that is updated or deleted in a few IN queries
+    ids = list({ops[i]["id"] for i in updates + deletes})
+    existing = set()
+    for chunk in chunks(ids):
+        existing.update(db.session.scalars(db.select(Todo.id).where(Todo.id.in_(chunk))))
+    for i in updates + deletes:
+        if ops[i]["id"] not in existing:
+            results[i] = {"status": "error", "error": "task not found", "id": ops[i]["id"]}
+    updates = [i for i in updates if results[i] is None]
+    deletes = [i for i in deletes if results[i] is None]
+    # Deletes run last, so an update to a task deleted in the same request
+    # would be thrown away; report it instead of claiming it succeeded
+    deleted_ids = {ops[i]["id"] for i in deletes}
+    for i in updates:
+        if ops[i]["id"] in deleted_ids:
+            results[i] = {
+                "status": "error",
+                "error": "conflict: the task is also deleted in this request",
+                "id": ops[i]["id"],
+            }
+    updates = [i for i in updates if results[i] is None]
+
+    try:
+        if creates:
+            now = datetime.utcnow()
+            # One multi-row INSERT per batch. sort_by_parameter_order=True would make
+            # SQLite fall back to a statement per row; SQLite hands out rowids in
+            # VALUES order anyway, so sorting the returned ids lines them up.
+            new_ids = sorted(
+                db.session.scalars(
+                    insert(Todo).returning(Todo.id),
+                    [{"content": ops[i]["content"], "date_created": now} for i in creates],
+                ).all()
+            )
+            for i, new_id in zip(creates, new_ids):
+                results[i] = {"status": "created", "id": new_id}
+        if updates:
+            db.session.execute(
+                sql_update(Todo),
+                [{"id": ops[i]["id"], "content": ops[i]["content"]} for i in updates],
+            )
+            for i in updates:
+                results[i] = {"status": "updated", "id": ops[i]["id"]}
+        for chunk in chunks(list({ops[i]["id"] for i in deletes})):
+            db.session.execute(sql_delete(Todo).where(Todo.id.in_(chunk)))
+        for i in deletes:
+            results[i] = {"status": "deleted", "id": ops[i]["id"]}
+        if creates or updates or deletes:
+            page_cache.invalidate()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        return jsonify(error="Something went wrong. No changes were saved."), 500
+
+    return jsonify(
+        results=results,
+        created=len(creates),
+        updated=len(updates),
+        deleted=len(deletes),
+    )
+
+
+def export_batches():
+    """Yields lists of (id, content, date_created) rows in id order."""
+    result = db.session.execute(
+        db.select(Todo.id, Todo.content, Todo.date_created)
+        .order_by(Todo.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    yield from result.partitions()
+
+
+def csv_export():
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(("id", "content", "date_created"))
+    for rows in export_batches():
+        writer.writerows(
+            (task_id, content, date_created.isoformat() if date_created else "")
+            for task_id, content, date_created in rows
+        )
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def jsonl_export():
+    for rows in export_batches():
+        yield "".join(
+            json.dumps(
+                {
+                    "id": task_id,
+                    "content": content,
+                    "date_created": date_created.isoformat() if date_created else None,
+                }
+            )
+            + "\n"
+            for task_id, content, date_created in rows
+        )
+
+
+EXPORT_FORMATS = {
+    "csv": (csv_export, "text/csv"),
+    "jsonl": (jsonl_export, "application/x-ndjson"),
+}
+
+
+@app.route("/api/tasks/export.<fmt>")
+def export_tasks(fmt):
+    """
+    Streams every task as CSV or JSON Lines, one batch of rows at a time, so
+    memory use stays flat however big the table is. The whole export reads
+    from one transaction, so it is a consistent snapshot.
+    """
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    generate, mimetype = EXPORT_FORMATS[fmt]
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={"Content-Disposition": 'attachment; filename="tasks.%s"' % fmt},
+    )
+
+
+def csv_records(text):
+    """Yields (line number, record) for each row of a CSV file with a header."""
+    reader = csv.DictReader(text)
+    if reader.fieldnames is None or "content" not in reader.fieldnames:
+        raise ValueError("the CSV header must have a 'content' column")
+    for record in reader:
+        yield reader.line_num, record
+
+
+def jsonl_records(text):
+    """Yields (line number, record) for each non-blank line of a JSON Lines file."""
+    for line_number, line in enumerate(text, 1):
+        if line.strip():
+            try:
+                yield line_number, json.loads(line)
+            except ValueError:
+                yield line_number, None
+
+
+IMPORT_FORMATS = {"csv": csv_records, "jsonl": jsonl_records}
+IMPORT_CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/x-ndjson": "jsonl",
+    "application/jsonl": "jsonl",
+}
+
+
+def import_format(upload):
+    """Picks the import format from ?format=, the file name, or the Content-Type."""
+    fmt = request.args.get("format")
+    if fmt is None and upload is not None and upload.filename:
+        fmt = upload.filename.rsplit(".", 1)[-1].lower()
+    if fmt is None:
+        fmt = IMPORT_CONTENT_TYPES.get(request.mimetype)
+    return fmt if fmt in IMPORT_FORMATS else None
+
+
+def check_record(record):
+    """Returns (row to insert, None) for a valid imported record, or (None, error)."""
+    if not isinstance(record, dict):
+        return None, "not a JSON object"
+    error = check_content(record)
+    if error:
+        return None, error
+    date_created = record.get("date_created")
+    if date_created:
+        try:
+            date_created = datetime.fromisoformat(date_created)
+        except (TypeError, ValueError):
+            return None, "date_created is not an ISO 8601 date"
+    else:
+        date_created = datetime.utcnow()
+    # Ids are not imported, so a file can be loaded next to existing tasks
+    return {"content": record["content"], "date_created": date_created}, None
+
+
+@app.route("/api/tasks/import", methods=["POST"])
+def import_tasks():
+    """
+    Adds tasks from a CSV (with a 'content' column and optionally
+    'date_created') or JSON Lines file, sent as the request body or as the
+    'file' field of a form upload. The file is parsed as it is read and
+    inserted IMPORT_BATCH_SIZE rows at a time. Each batch is committed on its
+    own, so a failure part way through keeps the batches before it; the
+    response says how many tasks were imported and lists the bad rows.
+    """
+    upload = request.files.get("file")
+    fmt = import_format(upload)
+    if fmt is None:
+        return jsonify(error="unknown format, use ?format=csv or ?format=jsonl"), 400
+    stream = upload.stream if upload is not None else io.BufferedReader(request.stream)
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+
+    imported = failed = 0
+    errors = []
+    batch = []
+
+    def flush():
+        nonlocal imported
+        db.session.execute(insert(Todo), batch)
+        page_cache.invalidate()
+        db.session.commit()
+        imported += len(batch)
+        batch.clear()
+
+    try:
+        for line_number, record in IMPORT_FORMATS[fmt](text):
+            row, error = check_record(record)
+            if error:
+                failed += 1
+                if len(errors) < MAX_IMPORT_ERRORS:
+                    errors.append({"line": line_number, "error": error})
+                continue
+            batch.append(row)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush()
+        if batch:
+            flush()
+    except (ValueError, csv.Error) as e:
+        # Includes UnicodeDecodeError
+        db.session.rollback()
+        return jsonify(error="Could not read the file: %s" % e, imported=imported), 400
+    except Exception:
+        db.session.rollback()
+        return jsonify(error="Something went wrong while saving.", imported=imported), 500
+
+    return jsonify(imported=imported, failed=failed, errors=errors)
+
+
+class RequestMetrics:
+    """
+    Per-route request latency histograms and SQL statistics, kept in memory
+    and rendered in the Prometheus text format by /metrics. Recording is a
+    few counter updates under a lock, cheap enough to leave on.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.latency = {}  # { (method, route): [bucket counts..., +Inf count, sum] }
+        self.requests = Counter()  # { (method, route, status): count }
+        self.sql_queries = Counter()  # { route: statements run }
+        self.sql_seconds = Counter()  # { route: seconds spent in statements }
+        self.slow_queries = Counter()  # { route: statements over SLOW_QUERY_SECONDS }
+        self.n_plus_one = Counter()  # { route: requests flagged as N+1 }
+
+    def observe_request(self, method, route, status, seconds, queries, sql_seconds):
+        with self.lock:
+            histogram = self.latency.get((method, route))
+            if histogram is None:
+                histogram = self.latency[(method, route)] = [0] * (len(self.buckets) + 2)
+            histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[-1] += seconds
+            self.requests[(method, route, status)] += 1
+            self.sql_queries[route] += queries
+            self.sql_seconds[route] += sql_seconds
+
+    def count(self, counter, route):
+        with self.lock:
+            counter[route] += 1
+
+    def prometheus_text(self):
+        lines = [
+            "# TYPE flask_request_duration_seconds histogram",
+        ]
+        with self.lock:
+            for (method, route), histogram in sorted(self.latency.items()):
+                labels = 'method="%s",route="%s"' % (method, route)
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), histogram):
+                    cumulative += count
+                    lines.append(
+                        'flask_request_duration_seconds_bucket{%s,le="%s"} %d'
+                        % (labels, bound, cumulative)
+                    )
+                lines.append("flask_request_duration_seconds_sum{%s} %f" % (labels, histogram[-1]))
+                lines.append("flask_request_duration_seconds_count{%s} %d" % (labels, cumulative))
+
+            lines.append("# TYPE flask_requests_total counter")
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append(
+                    'flask_requests_total{method="%s",route="%s",status="%d"} %d'
+                    % (method, route, status, count)
+                )
+            for name, counter, kind in (
+                ("flask_sql_queries_total", self.sql_queries, "counter"),
+                ("flask_sql_duration_seconds_total", self.sql_seconds, "counter"),
+                ("flask_sql_slow_queries_total", self.slow_queries, "counter"),
+                ("flask_sql_n_plus_one_total", self.n_plus_one, "counter"),
+            ):
+                lines.append("# TYPE %s %s" % (name, kind))
+                for route, value in sorted(counter.items()):
+                    lines.append('%s{route="%s"} %s' % (name, route, value))
+
+        page_stats = page_cache.stats()
+        lines.append("# TYPE flask_page_cache_hits_total counter")
+        lines.append("flask_page_cache_hits_total %d" % page_stats["hits"])
+        lines.append("# TYPE flask_page_cache_misses_total counter")
+        lines.append("flask_page_cache_misses_total %d" % page_stats["misses"])
+        lines.append("# TYPE flask_page_cache_not_modified_total counter")
+        lines.append("flask_page_cache_not_modified_total %d" % page_stats["not_modified"])
+        return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics()
+
+
+def current_route():
+    # The URL rule rather than the path, so /update/1 and /update/2 share a series
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+    g.sql_statements = Counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    route = current_route()
+    request_metrics.observe_request(
+        request.method,
+        route,
+        response.status_code,
+        time.perf_counter() - started,
+        g.sql_queries,
+        g.sql_seconds,
+    )
+    repeated = g.sql_statements.most_common(1)
+    if repeated and repeated[0][1] >= N_PLUS_ONE_THRESHOLD:
+        request_metrics.count(request_metrics.n_plus_one, route)
+        app.logger.warning(
+            "Possible N+1 on %s %s: %d runs of %s",
+            request.method,
+            route,
+            repeated[0][1],
+            repeated[0][0][:200],
+        )
+    return response
+
+
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def record_query_metrics(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["query_started"].pop()
+    if not has_request_context() or "sql_statements" not in g:
+        return  # Startup, CLI commands and the like
+    g.sql_queries += 1
+    g.sql_seconds += seconds
+    if not executemany:  # A repeated executemany() is already batching its rows
+        g.sql_statements[statement] += 1
+    if seconds >= SLOW_QUERY_SECONDS:
+        request_metrics.count(request_metrics.slow_queries, current_route())
+        app.logger.warning("Slow query (%.3fs): %s", seconds, statement[:200])
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(request_metrics.prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+
+def create_schema():
+    db.create_all()
+    # create_all() skips tables that already exist, so add new indexes to them here
+    for index in Todo.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    if db.engine.dialect.name == "sqlite":
+        is_new = not db.inspect(db.engine).has_table("todo_fts")
+        with db.engine.begin() as connection:
+            for statement in SEARCH_SCHEMA:
+                connection.exec_driver_sql(statement)
+        if is_new:
+            rebuild_search_index()  # Index the tasks that predate the search table
+    if db.session.get(PageVersion, 1) is None:
+        db.session.add(PageVersion(id=1, version=0, modified=int(time.time())))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # Another worker added it first
+
+
+def rebuild_search_index():
+    """Re-indexes every task from scratch, e.g. after restoring a backup."""
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO todo_fts(todo_fts) VALUES ('rebuild')")
+
+
+@app.cli.command("rebuild-search")
+def rebuild_search_command():
+    """Rebuild the full-text search index from the todo table."""
+    if not uses_fts():
+        print("No search index on this database; search uses LIKE queries.")
+        return
+    rebuild_search_index()
+    print("Search index rebuilt.")
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Applies the profile's SQLITE_PRAGMAS to every new connection."""
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config["SQLITE_PRAGMAS"].items():
+        cursor.execute("PRAGMA %s = %s" % (name, value))
+    cursor.close()
+
+
+with app.app_context():
+    if db.engine.dialect.name == "sqlite" and app.config["SQLITE_PRAGMAS"]:
+        event.listen(db.engine, "connect", set_sqlite_pragmas)
+    event.listen(db.engine, "before_cursor_execute", start_query_timer)
+    event.listen(db.engine, "after_cursor_execute", record_query_metrics)
+    try:
+        create_schema()
+    except OperationalError:
+        # Workers starting together can race to create the same table; the
+        # loser's checks now see it
+        create_schema()
+
+
 if __name__ == "__main__":
     app.run(debug=True)
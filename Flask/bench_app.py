@@ -0,0 +1,348 @@
+"""
+Load-testing benchmark for the task app (app.py).
+
+For each table size it seeds a fresh SQLite file with that many tasks, then
+runs a mix of traffic against it for a fixed time:
+    list   - GET /, the first page
+    page   - GET /?after=<cursor>, a page from a random point in the list
+    create - POST / with a new task
+    update - POST /update/<id>
+    delete - GET /delete/<id>
+
+Two modes:
+    client - the app's test client from threads in one process (no HTTP)
+    server - several server processes sharing one listening socket (like
+             gunicorn workers), driven over HTTP by several client processes
+
+Reports requests per second plus p50/p95/p99 latency per route as JSON.
+
+Usage: python bench_app.py [--rows 1000,100000] [--mode client|server]
+                           [--workers N] [--clients N] [--duration SECONDS]
+                           [--mix list=50,page=20,create=10,update=15,delete=5]
+                           [--profile development|production] [--output results.json]
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+
+from bench_utils import configure_app, fill_and_put, git_commit, request_failed
+
+DEFAULT_MIX = "list=50,page=20,create=10,update=15,delete=5"
+SEED_BATCH_SIZE = 10000
+# Seeded task i was created at SEED_START + i seconds, so any cursor can be
+# rebuilt without asking the database
+SEED_START = datetime(2024, 1, 1)
+
+
+def _seed(db_path, rows):
+    configure_app(db_path, "development")
+    from sqlalchemy import insert
+
+    from app import Todo, app, db
+
+    with app.app_context():
+        for start in range(1, rows + 1, SEED_BATCH_SIZE):
+            stop = min(start + SEED_BATCH_SIZE, rows + 1)
+            db.session.execute(
+                insert(Todo),
+                [
+                    {
+                        "id": i,
+                        "content": "Seeded task number %d" % i,
+                        "date_created": SEED_START + timedelta(seconds=i),
+                    }
+                    for i in range(start, stop)
+                ],
+            )
+            db.session.commit()
+
+
+def seed(db_path, rows):
+    """Creates the schema and 'rows' tasks in db_path. Returns the time taken."""
+    start = time.perf_counter()
+    # In a child process, since each database needs a fresh import of the app
+    process = multiprocessing.get_context("spawn").Process(target=_seed, args=(db_path, rows))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("Seeding the database failed.")
+    return time.perf_counter() - start
+
+
+def parse_mix(text):
+    """'list=50,create=10' -> (['list', 'create'], [50.0, 10.0])"""
+    routes, weights = [], []
+    for part in text.split(","):
+        route, _, weight = part.partition("=")
+        if route not in ("list", "page", "create", "update", "delete"):
+            raise ValueError("Unknown route in --mix: %r" % route)
+        routes.append(route)
+        weights.append(float(weight))
+    return routes, weights
+
+
+def next_request(route, rows):
+    """Returns (method, path, form data) for one request of the given kind."""
+    task_id = random.randint(1, rows)
+    if route == "list":
+        return "GET", "/", None
+    if route == "page":
+        cursor = "%s_%d" % ((SEED_START + timedelta(seconds=task_id)).isoformat(), task_id)
+        return "GET", "/?after=" + cursor, None
+    if route == "create":
+        return "POST", "/", {"content": "Benchmark task"}
+    if route == "update":
+        return "POST", "/update/%d" % task_id, {"content": "Updated task %d" % task_id}
+    return "GET", "/delete/%d" % task_id, None
+
+
+def _record(samples, route, seconds, status, data):
+    # 404s are expected: a delete or update can pick a task already deleted
+    entry = samples.setdefault(route, {"latencies": [], "errors": 0, "not_found": 0})
+    entry["latencies"].append(seconds)
+    if request_failed(status, data):
+        entry["errors"] += 1
+    elif status == 404:
+        entry["not_found"] += 1
+
+
+def _run_test_client(db_path, profile, rows, clients, duration, mix, samples):
+    configure_app(db_path, profile)
+    from app import app
+
+    routes, weights = parse_mix(mix)
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def run():
+        client = app.test_client()
+        mine = {}
+        while time.perf_counter() < deadline:
+            route = random.choices(routes, weights)[0]
+            method, path, form = next_request(route, rows)
+            start = time.perf_counter()
+            response = client.open(path, method=method, data=form)
+            elapsed = time.perf_counter() - start
+            _record(mine, route, elapsed, response.status_code, response.data)
+        with lock:
+            _merge(samples, mine)
+
+    threads = [threading.Thread(target=run) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _serve(listener, db_path, profile):
+    """One server worker: a threaded WSGI server on the shared listening socket."""
+    import logging
+
+    from werkzeug.serving import make_server
+
+    configure_app(db_path, profile)
+    from app import app
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # No line per request
+    host, port = listener.getsockname()
+    make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+
+
+def _run_http_client(port, rows, duration, mix, samples):
+    routes, weights = parse_mix(mix)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        route = random.choices(routes, weights)[0]
+        method, path, form = next_request(route, rows)
+        body = headers = None
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        start = time.perf_counter()
+        try:
+            # Keep-alive, so most requests reuse the connection
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            data = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            status, data = 599, b""
+        _record(samples, route, time.perf_counter() - start, status, data)
+    connection.close()
+
+
+def wait_until_serving(port, timeout=30):
+    """Polls the server until it answers a request."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/metrics")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.1)
+    raise RuntimeError("Server did not start.")
+
+
+def _merge(total, samples):
+    for route, entry in samples.items():
+        merged = total.setdefault(route, {"latencies": [], "errors": 0, "not_found": 0})
+        merged["latencies"].extend(entry["latencies"])
+        merged["errors"] += entry["errors"]
+        merged["not_found"] += entry["not_found"]
+
+
+def _collect(results, count):
+    samples = {}
+    for _ in range(count):
+        _merge(samples, results.get())
+    return samples
+
+
+def run_client_mode(db_path, profile, rows, clients, duration, mix):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(
+        target=fill_and_put,
+        args=(results, {}, _run_test_client, db_path, profile, rows, clients, duration, mix),
+    )
+    process.start()
+    samples = _collect(results, 1)
+    process.join()
+    return samples
+
+
+def run_server_mode(db_path, profile, rows, workers, clients, duration, mix):
+    # Forked workers inherit the listening socket; they accept from it in turn
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(128)
+    port = listener.getsockname()[1]
+    fork = multiprocessing.get_context("fork")
+    servers = [
+        fork.Process(target=_serve, args=(listener, db_path, profile), daemon=True)
+        for _ in range(workers)
+    ]
+    for server in servers:
+        server.start()
+    try:
+        wait_until_serving(port)
+        spawn = multiprocessing.get_context("spawn")
+        results = spawn.Queue()
+        client_processes = [
+            spawn.Process(
+                target=fill_and_put,
+                args=(results, {}, _run_http_client, port, rows, duration, mix),
+            )
+            for _ in range(clients)
+        ]
+        for process in client_processes:
+            process.start()
+        samples = _collect(results, clients)
+        for process in client_processes:
+            process.join()
+        return samples
+    finally:
+        for server in servers:
+            server.terminate()
+            server.join()
+        listener.close()
+
+
+def summarize(samples, duration):
+    """Turns raw latencies into requests/s and millisecond percentiles per route."""
+
+    def percentile(latencies, q):
+        return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 3)
+
+    routes = {}
+    total = 0
+    for route, entry in sorted(samples.items()):
+        latencies = sorted(entry["latencies"])
+        total += len(latencies)
+        routes[route] = {
+            "requests": len(latencies),
+            "requests_per_s": round(len(latencies) / duration, 1),
+            "errors": entry["errors"],
+            "not_found": entry["not_found"],
+            "p50_ms": percentile(latencies, 0.50),
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+        }
+    return {"requests_per_s": round(total / duration, 1), "routes": routes}
+
+
+def run(sizes, mode="client", workers=4, clients=8, duration=10.0, mix=DEFAULT_MIX, profile="production"):
+    parse_mix(mix)  # Fail before seeding anything
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "mode": mode,
+            "workers": workers if mode == "server" else 1,
+            "clients": clients,
+            "duration_s": duration,
+            "mix": mix,
+            "profile": profile,
+        },
+        "runs": [],
+    }
+    for rows in sizes:
+        db_dir = tempfile.mkdtemp()
+        db_path = os.path.join(db_dir, "bench.db")
+        seed_seconds = seed(db_path, rows)
+        if mode == "server":
+            samples = run_server_mode(db_path, profile, rows, workers, clients, duration, mix)
+        else:
+            samples = run_client_mode(db_path, profile, rows, clients, duration, mix)
+        summary = summarize(samples, duration)
+        results["runs"].append({"rows": rows, "seed_s": round(seed_seconds, 2), **summary})
+        print(
+            f"{rows:>9,} rows: {summary['requests_per_s']:,.0f} requests/s",
+            file=sys.stderr,
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", default="1000,100000", help="comma-separated table sizes")
+    parser.add_argument("--mode", default="client", choices=("client", "server"))
+    parser.add_argument("--workers", type=int, default=4, help="server processes (server mode)")
+    parser.add_argument("--clients", type=int, default=8, help="client threads or processes")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per table size")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="route=weight pairs")
+    parser.add_argument("--profile", default="production", choices=("development", "production"))
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.rows.split(",")]
+    results = run(
+        sizes, args.mode, args.workers, args.clients, args.duration, args.mix, args.profile
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,117 @@
+"""
+Time to first byte and peak memory of the all-tasks page, rendered whole
+versus streamed.
+
+    buffered - the way index() renders: query.all(), then render_template()
+               builds the whole page as one string before anything is sent
+    streamed - the /all route: stream_template() over a yield_per query,
+               sent in chunks while later rows are still being fetched
+
+Each table size is seeded with bench_app.seed() and measured in-process with
+the test client. Timings and memory are taken in separate passes, since
+tracemalloc slows everything down. Results are printed as JSON.
+
+Usage: python bench_render.py [--rows 10000,100000] [--repeat N] [--output results.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench_app import seed
+from bench_utils import configure_app, fill_and_put
+
+
+def _measure(db_path, repeat, summary):
+    configure_app(db_path, "development")
+    from flask import render_template
+
+    from app import Todo, app, db
+
+    def buffered():
+        with app.test_request_context("/all"):
+            start = time.perf_counter()
+            tasks = db.session.scalars(
+                db.select(Todo).order_by(Todo.date_created, Todo.id)
+            ).all()
+            html = render_template("all.html", tasks=tasks)
+            # Nothing can be sent until the whole page exists
+            elapsed = time.perf_counter() - start
+            db.session.remove()
+            return elapsed, elapsed, len(html)
+
+    def streamed():
+        client = app.test_client()
+        start = time.perf_counter()
+        response = client.get("/all", buffered=False)
+        chunks = iter(response.response)
+        size = len(next(chunks))
+        first_byte = time.perf_counter() - start
+        for chunk in chunks:
+            size += len(chunk)
+        elapsed = time.perf_counter() - start
+        response.close()
+        return first_byte, elapsed, size
+
+    for name, render in (("buffered", buffered), ("streamed", streamed)):
+        render()  # Warm up Jinja's template cache and SQLite's page cache
+        timings = sorted(render()[:2] for _ in range(repeat))
+        median = timings[len(timings) // 2]
+        tracemalloc.start()
+        _, _, size = render()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        summary[name] = {
+            "ttfb_ms": round(median[0] * 1000, 2),
+            "total_ms": round(median[1] * 1000, 2),
+            "peak_memory_kb": peak // 1024,
+            "bytes": size,
+        }
+
+
+def run(sizes, repeat=5):
+    results = {"runs": []}
+    context = multiprocessing.get_context("spawn")
+    for rows in sizes:
+        db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+        seed(db_path, rows)
+        # A fresh process per size, since the app binds its database at import
+        queue = context.Queue()
+        process = context.Process(
+            target=fill_and_put, args=(queue, {}, _measure, db_path, repeat)
+        )
+        process.start()
+        summary = queue.get()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError("Measuring %d rows failed." % rows)
+        results["runs"].append({"rows": rows, **summary})
+        print(
+            f"{rows:>9,} rows: first byte {summary['buffered']['ttfb_ms']}ms -> "
+            f"{summary['streamed']['ttfb_ms']}ms, peak memory "
+            f"{summary['buffered']['peak_memory_kb']}KB -> {summary['streamed']['peak_memory_kb']}KB",
+            file=sys.stderr,
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", default="10000,100000", help="comma-separated table sizes")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per mode (median kept)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run([int(size) for size in args.rows.split(",")], args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,50 @@
+"""
+Helpers shared by the task app's benchmark and stress scripts
+(bench_app.py, bench_render.py, stress_db.py).
+"""
+
+import os
+import subprocess
+
+
+def configure_app(db_path, profile):
+    """
+    Points the app at db_path with the given TASKS_DB_PROFILE. The app reads
+    both at import time, so call this in the worker process before importing it.
+    """
+    os.environ["DATABASE_URL"] = "sqlite:///" + db_path
+    os.environ["TASKS_DB_PROFILE"] = profile
+
+
+def request_failed(status, body):
+    """
+    True for a 5xx response, and for the 200 page the form routes send when
+    their commit fails ("Something went wrong..."), so lock errors under load
+    aren't counted as fast successful requests.
+    """
+    return status >= 500 or b"Something went wrong" in body
+
+
+def fill_and_put(results, result, fn, *args):
+    """
+    Process target: calls fn(*args, result), which fills in the 'result'
+    dict, then puts it on the 'results' queue. It is put even if fn raised,
+    so a parent blocked in results.get() never waits forever on a crashed worker.
+    """
+    try:
+        fn(*args, result)
+    finally:
+        results.put(result)
+
+
+def git_commit():
+    """Short hash of the checked-out commit, for tagging results; None outside git."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
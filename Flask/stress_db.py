@@ -0,0 +1,109 @@
+"""
+Concurrent read/write stress test for the task app's database settings.
+
+Starts several worker processes (like gunicorn workers), each with a few
+request threads, all hitting one SQLite file through app.test_client():
+mostly page reads, plus creates, updates and deletes. Reports requests per
+second and how many requests failed, e.g. with "database is locked".
+
+Usage: python stress_db.py [--profile development|production] [--processes N]
+                           [--threads N] [--duration SECONDS] [--writes FRACTION]
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+
+from bench_utils import configure_app, fill_and_put, request_failed
+
+
+def _run_requests(db_path, profile, threads, duration, writes, counts):
+    configure_app(db_path, profile)
+    from app import app
+
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def run():
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            is_write = random.random() < writes
+            try:
+                if not is_write:
+                    response = client.get("/?per_page=%d" % random.randint(10, 50))
+                elif random.random() < 0.6:
+                    response = client.post("/", data={"content": "stress task"})
+                else:
+                    task_id = random.randint(1, 2000)
+                    response = client.post(
+                        "/api/tasks/bulk",
+                        json=[
+                            {"op": "update", "id": task_id, "content": "updated"},
+                            {"op": "delete", "id": task_id + 1},
+                        ],
+                    )
+                failed = request_failed(response.status_code, response.data)
+            except Exception:
+                failed = True
+            with lock:
+                counts["errors" if failed else ("writes" if is_write else "reads")] += 1
+
+    request_threads = [threading.Thread(target=run) for _ in range(threads)]
+    for thread in request_threads:
+        thread.start()
+    for thread in request_threads:
+        thread.join()
+
+
+def run(profile="production", processes=4, threads=4, duration=5.0, writes=0.2):
+    """Runs the stress test on a fresh database file and returns the totals."""
+    db_dir = tempfile.mkdtemp()
+    db_path = os.path.join(db_dir, "stress.db")
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = [
+        context.Process(
+            target=fill_and_put,
+            args=(
+                results,
+                {"reads": 0, "writes": 0, "errors": 0},
+                _run_requests,
+                db_path,
+                profile,
+                threads,
+                duration,
+                writes,
+            ),
+        )
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    totals = {"reads": 0, "writes": 0, "errors": 0}
+    for _ in workers:
+        for key, value in results.get().items():
+            totals[key] += value
+    for worker in workers:
+        worker.join()
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--profile", default="production", choices=("development", "production"))
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--writes", type=float, default=0.2, help="fraction of requests that write")
+    args = parser.parse_args()
+
+    totals = run(args.profile, args.processes, args.threads, args.duration, args.writes)
+    requests = sum(totals.values())
+    print(f"Profile: {args.profile}, {args.processes} processes x {args.threads} threads")
+    print(f"  {requests / args.duration:,.0f} requests/s")
+    print(f"  reads ok: {totals['reads']}, writes ok: {totals['writes']}")
+    print(f"  failed: {totals['errors']} ({totals['errors'] / max(requests, 1):.1%})")
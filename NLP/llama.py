@@ -9,34 +9,117 @@ from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.llms.openai import OpenAI
 
+import hashlib
+import json
 import os
+import shutil
+import tempfile
 import warnings
 warnings.filterwarnings('ignore')
-import os
 from dotenv import load_dotenv 
 
 load_dotenv()
 
-def remove_first_and_last(lst):
-    return [s[1:-1] if len(s) > 1 else '' for s in lst]
-def main_match(user_req, filename):
-    # Get the directory of this script
-    script_dir = os.path.dirname(__file__)
-    # Construct the full path to the file
-    file_path = os.path.join(script_dir, filename)
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+CHUNK_SIZE = 1024
+CHUNK_OVERLAP = 200
+# Bump this when the way indexes are built changes, so old ones get rebuilt
+INDEX_VERSION = 1
+
+# Directory of this script; input files and storage_mini live next to it
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STORAGE_ROOT = os.path.join(SCRIPT_DIR, "storage_mini")
 
+_settings_ready = False
+_indexes = {}  # { input file's storage folder: (key, index) } for repeat calls in this process
+
+
+def configure_settings():
+    # Loading the embedding model takes seconds, so do it once per process
+    global _settings_ready
+    if _settings_ready:
+        return
     Settings.llm = OpenAI(model="o1-preview", api_key=os.getenv("OPENAI_API_KEY"))
-    Settings.embed_model = HuggingFaceEmbedding(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    Settings.node_parser = SentenceSplitter(chunk_size=1024, chunk_overlap=200)
+    Settings.embed_model = HuggingFaceEmbedding(model_name=EMBED_MODEL)
+    Settings.node_parser = SentenceSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    _settings_ready = True
+
+
+def index_key(file_path):
+    # Hash of the file's bytes plus every setting that changes how it is
+    # chunked and embedded, so any change to either builds a new index
+    digest = hashlib.sha256()
+    settings = {
+        "embed_model": EMBED_MODEL,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "version": INDEX_VERSION,
+    }
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def file_storage_dir(file_path):
+    # One folder per input file: its name plus a hash of its full path, so
+    # two files called data.json in different folders don't collide
+    path_hash = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:8]
+    return os.path.join(STORAGE_ROOT, "%s-%s" % (os.path.basename(file_path), path_hash))
 
-    reader = SimpleDirectoryReader(input_files=[file_path])
-    documents = reader.load_data()
+
+def build_index(file_path, persist_dir):
+    documents = SimpleDirectoryReader(input_files=[file_path]).load_data()
     nodes = Settings.node_parser.get_nodes_from_documents(documents, show_progress=True)
+    # Index the nodes just split, rather than having from_documents() split them again
+    index = VectorStoreIndex(nodes)
+
+    # Persist to a temporary folder and rename it into place, so a crash or
+    # another process building the same index never leaves half of one behind
+    parent = os.path.dirname(persist_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".building-", dir=parent)
+    index.storage_context.persist(persist_dir=tmp_dir)
+    try:
+        os.rename(tmp_dir, persist_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)  # Someone else finished it first
+
+    # Drop the indexes of older versions of this file
+    for entry in os.listdir(parent):
+        if entry != os.path.basename(persist_dir) and not entry.startswith(".building-"):
+            shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+    return index
+
+
+def get_index(file_path):
+    # Loads the file's index from storage_mini, building it only if the file
+    # or the settings changed since it was last built
+    storage_dir = file_storage_dir(file_path)
+    key = index_key(file_path)
+    cached = _indexes.get(storage_dir)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    persist_dir = os.path.join(storage_dir, key)
+    if os.path.isdir(persist_dir):
+        storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+        index = load_index_from_storage(storage_context)
+    else:
+        index = build_index(file_path, persist_dir)
+    _indexes[storage_dir] = (key, index)
+    return index
+
+
+def remove_first_and_last(lst):
+    return [s[1:-1] if len(s) > 1 else '' for s in lst]
+def main_match(user_req, filename):
+    # Construct the full path to the file
+    file_path = os.path.join(SCRIPT_DIR, filename)
 
-    vector_index = VectorStoreIndex.from_documents(documents, node_parser=nodes)
-    vector_index.storage_context.persist(persist_dir="storage_mini")
-    storage_context = StorageContext.from_defaults(persist_dir="storage_mini")
-    index = load_index_from_storage(storage_context)
+    configure_settings()
+    index = get_index(file_path)
     query_engine = index.as_query_engine()
 
     q6 = f""" 